@@ -299,7 +299,8 @@ class App(ctk.CTk):
         if os.path.isdir(path) and os.path.exists(package_path):
             if not self._am or self._am.root != os.path.abspath(path):
                 try:
-                    self._am = AssetManager(path)
+                    executor, workers = config_utils.load_extraction_settings()
+                    self._am = AssetManager(path, executor, workers)
                     # Enable buttons
                     self._enable_all_buttons()
                 except Exception as e:
@@ -1,22 +1,41 @@
-import io
+import mmap
 import os
 import shutil
+import struct
+import threading
 import zipfile
-from concurrent.futures import ThreadPoolExecutor, as_completed
+import zlib
+from collections import defaultdict
+from contextlib import contextmanager
+from concurrent.futures import (
+    Executor,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    as_completed,
+)
 from enum import Enum, auto
-from typing import Callable, Dict, List, Optional, Set, Tuple, Union
-
-from lxml import etree as et
+from typing import (
+    Callable,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 import lib.ui_logger as logging
 from lib.crypt_utils import Crypt
+from lib.extract_manifest import ExtractManifest, FileRecord
+from lib.index_cache import IndexCache, IndexFingerprint
 from lib.index_file_helper import IndexFileHelper
+from lib.index_table import Entry, IndexTable
 from lib.utils import Utils
 
-Element = et._Element
-
 logging.basicConfig(format="%(levelname)s - %(filename)s:%(lineno)d - %(message)s")
-parser = et.XMLParser(collect_ids=False, remove_comments=True)
 
 
 class ExtractionStatus(Enum):
@@ -27,54 +46,97 @@ class ExtractionStatus(Enum):
     SKIPPED = auto()
 
 
+# (virtual name, original, destination path) of one file to extract.
+# Plain strings only, so jobs can be sent to worker processes.
+ExtractJob = Tuple[Optional[str], str, str]
+# status of one job and, unless it failed, the record of the file on disk
+ExtractResult = Tuple[ExtractionStatus, Optional[FileRecord]]
+# a piece of an extracted file, a view into a mapped pack when possible
+Chunk = Union[bytes, memoryview]
+
+# zip local file header (APPNOTE 4.3.7), 30 bytes before the member's name,
+# extra field and data
+ZIP_LOCAL_HEADER = struct.Struct("<4s2B4HL2L2H")
+ZIP_LOCAL_SIGNATURE = b"PK\003\004"
+# indexes of the signature, name length and extra field length
+_LH_SIGNATURE = 0
+_LH_NAME_LENGTH = 10
+_LH_EXTRA_LENGTH = 11
+
+
 class AssetManager:
-    def __init__(self, game_root: str):
+    EXECUTORS: Dict[str, Callable[..., Executor]] = {
+        "thread": ThreadPoolExecutor,
+        "process": ProcessPoolExecutor,
+    }
+    # read/inflate/compare granularity while extracting
+    CHUNK_SIZE = 1 << 20
+
+    def __init__(
+        self,
+        game_root: str,
+        executor: str = "thread",
+        max_workers: Optional[int] = None,
+    ):
+        """
+        executor: 'thread' (default) or 'process'. Processes avoid the GIL for
+            decrypt/inflate/compare heavy extractions, at a startup cost.
+        max_workers: worker count, None for the executor's default.
+        """
+        if executor not in self.EXECUTORS:
+            raise ValueError(
+                f"Unknown executor '{executor}', expected one of {list(self.EXECUTORS)}"
+            )
         self.root = game_root
         self.package_path = os.path.join(self.root, "Package")
         self.data_path = os.path.join(self.root, "Data")
         self.mods_path = os.path.join(self.root, "Mods")
         self.index_file = os.path.join(self.package_path, "index")
         self.index_file_backup = self.index_file + ".backup"
-        self._index_root: Optional[Element] = None
-        self._extraction_methods: Dict[str, Callable] = {
-            "raw": AssetManager._extract_raw,
-            "zip": AssetManager._extract_from_zip,
-            "encrypted_zip": AssetManager._extract_from_encrypted_zip,
-        }
-        self._xpath_has_data_pack = et.XPath("entry[starts-with(@pack, '../Data/')]")
-        # self._xpath_entry_startswith_original = et.XPath(
-        #     "entry[starts-with(translate(@original, '\\', '/'), $target)]"
-        # )
-        # self._xpath_entry_by_original = et.XPath(
-        #     "entry[translate(@original, '\\', '/')=$target]"
-        # )
+        self.cache_path = os.path.join(self.data_path, ".cache")
+        self._index: Optional[IndexTable] = None
+        self._index_cache = IndexCache(os.path.join(self.cache_path, "index.bin"))
+        self._manifest = ExtractManifest(
+            os.path.join(self.cache_path, "extracted.json")
+        )
+        self.index_xml_file = os.path.join(self.data_path, "index.xml")
+        self.index_xml_stamp = os.path.join(self.cache_path, "index.xml.stamp")
+        self._index_xml_lock = threading.Lock()
+        self.executor = executor
+        self.max_workers = max_workers
 
         logging.info(f"AssetManager initialized at: {self.root}\n")
 
     @property
-    def index_root(self) -> Element:
-        if self._index_root is None:
+    def index(self) -> IndexTable:
+        if self._index is None:
             self._load_index()
 
-        return self._index_root  # type: ignore
+        return self._index  # type: ignore
 
-    @index_root.setter
-    def index_root(self, value: Element):
-        self._index_root = value
+    @index.setter
+    def index(self, value: IndexTable):
+        self._index = value
 
     def _load_index(self):
-        # Load Package/index
-        # if self.index_root is None:
-        self.index_root = et.fromstring(
-            IndexFileHelper.load_index(self.index_file), parser
-        )
-        if self.index_root is None:
-            raise ValueError("Index is empty: Package/index not found or corrupted.")
-
-        # Save a human-readable copy to Data/index.xml for reference
-        self._write_xml_to_data_dir(self.index_root)
+        # Load Package/index, from the parsed cache when the file is unchanged
+        fingerprint = IndexFingerprint.of(self.index_file)
+        index = self._index_cache.load(fingerprint)
+        xml_bytes = None
+        if index is None:
+            xml_bytes, zipped = IndexFileHelper.read_index(
+                self.index_file, strip_padding=True
+            )
+            index = IndexTable.from_xml(xml_bytes, zipped)
+            self._index_cache.save(fingerprint, index)
+            logging.info(f"Loaded index from: {self.index_file}")
+        else:
+            logging.info(f"Loaded index from cache: {self._index_cache.cache_file}")
+        self.index = index
 
-        logging.info(f"Loaded index from: {self.index_file}")
+        # Refresh the human-readable Data/index.xml in the background
+        if self._index_xml_outdated(fingerprint):
+            Utils.task(self.dump_index_xml, fingerprint, xml_bytes)
 
     def _backup_index(self):
         logging.info("Backing up Index...")
@@ -83,7 +145,7 @@ class AssetManager:
             logging.warning("Already exists and not different. Skip.")
             return
 
-        if self._xpath_has_data_pack(self.index_root):
+        if self.index.has_data_pack():
             logging.warning("'../Data/' in packs. Index may not be original. Skip.")
             return
 
@@ -104,124 +166,341 @@ class AssetManager:
         # must reload index
         self._load_index()
 
-        if not self._xpath_has_data_pack(self.index_root):
+        if not self.index.has_data_pack():
             logging.warning("No '../Data/' in packs. Index may be original. Skip.")
             return
 
         shutil.copy2(self.index_file_backup, self.index_file)
         logging.info("Index restored.")
 
-    def _write_xml_to_data_dir(self, xml_root: Element):
-        data_index_xml_file = os.path.join(self.data_path, "index.xml")
-        if not os.path.exists(data_index_xml_file):
-            txt = et.tostring(xml_root, encoding="utf-8", xml_declaration=True)
-            os.makedirs(self.data_path, exist_ok=True)
-            try:
-                with open(data_index_xml_file, "wb") as f:
-                    f.write(txt)
-            except IOError as e:
-                logging.error(f"Error writing index.xml: {e}")
-
-    def _save_index(self, mod_index_xml: Optional[Element] = None) -> None:
-        if mod_index_xml is None:
-            mod_index_xml = self.index_root
-        if mod_index_xml is None:
+    def _index_xml_outdated(self, fingerprint: IndexFingerprint) -> bool:
+        if not os.path.exists(self.index_xml_file):
+            return True
+        try:
+            with open(self.index_xml_stamp, "r", encoding="utf-8") as f:
+                return IndexFingerprint.from_text(f.read()) != fingerprint
+        except OSError:
+            return True
+
+    def dump_index_xml(
+        self,
+        fingerprint: Optional[IndexFingerprint] = None,
+        xml_bytes: Optional[bytes | bytearray | memoryview] = None,
+    ) -> bool:
+        """
+        Writes the decrypted Package/index to Data/index.xml for reference and
+        stamps it with the index fingerprint, so it is only redone when the
+        index changes. Without `xml_bytes` the index file is read again.
+        Returns False if skipped (another dump running, index changed meanwhile).
+        """
+        if not self._index_xml_lock.acquire(blocking=False):
+            logging.debug("index.xml dump already running, skip.")
+            return False
+        try:
+            if fingerprint is None:
+                fingerprint = IndexFingerprint.of(self.index_file)
+            if xml_bytes is None:
+                try:
+                    xml_bytes, _ = IndexFileHelper.read_index(
+                        self.index_file, strip_padding=True
+                    )
+                except Exception:
+                    # a restore may rewrite the file under us, that's not an error
+                    if IndexFingerprint.of(self.index_file) == fingerprint:
+                        raise
+                if IndexFingerprint.of(self.index_file) != fingerprint:
+                    logging.debug("Index changed while dumping index.xml, skip.")
+                    return False
+
+            tmp_file = self.index_xml_file + ".tmp"
+            os.makedirs(self.cache_path, exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                f.write(xml_bytes)
+            os.replace(tmp_file, self.index_xml_file)
+            with open(self.index_xml_stamp, "w", encoding="utf-8") as f:
+                f.write(fingerprint.to_text())
+            logging.debug(f"Wrote {self.index_xml_file}")
+            return True
+        except Exception as e:
+            logging.error(f"Error writing index.xml: {e}")
+            return False
+        finally:
+            self._index_xml_lock.release()
+
+    def _save_index(self, index: Optional[IndexTable] = None) -> None:
+        if index is None:
+            index = self.index
+        if index is None:
             raise ValueError("Index is empty.")
+        if not index.is_dirty:
+            logging.debug("Index not changed, skip saving.")
+            return
 
-        source_bytes = et.tostring(
-            mod_index_xml, encoding="utf-8", xml_declaration=True
+        logging.debug(f"{len(index.dirty_entries)} index entries changed.")
+        IndexFileHelper.save_index_chunks(
+            index.iter_xml(), self.index_file, index.zipped
         )
-        IndexFileHelper.save_index(source_bytes, self.index_file)
+        index.mark_clean()
+        # the saved file is the new fingerprint, keep the cache in step
+        self._index_cache.save(IndexFingerprint.of(self.index_file), index)
 
-    @staticmethod
-    def _edit_index(entry: Element, original: str):
-        entry.set("method", "raw")
-        entry.set("pack", f"../Data/{original.replace('\\', '/')}")
-        # entry.set("pack", os.path.join("..", "Data", original))
-        entry.set("virtual", os.path.basename(original))
+    def _edit_index(self, entry: Entry, original: str):
         size = entry.get("size", "0")
-        entry.set("csize", size)
+        self.index.update_entry(
+            entry,
+            {
+                "method": "raw",
+                "pack": f"../Data/{original.replace('\\', '/')}",
+                # "pack": os.path.join("..", "Data", original),
+                "virtual": os.path.basename(original),
+                "csize": size,
+            },
+        )
+
+    @staticmethod
+    @contextmanager
+    def _map_file(file_path: str) -> Iterator[memoryview]:
+        """
+        Maps `file_path` read-only. Workers mapping the same pack share its
+        pages through the OS page cache instead of each reading a copy.
+        """
+        with open(file_path, "rb") as f:
+            if os.fstat(f.fileno()).st_size == 0:
+                yield memoryview(b"")  # empty files can't be mapped
+                return
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        with mm:
+            view = memoryview(mm)
+            try:
+                yield view
+            finally:
+                # the map can't close while a view exports it; slices of the
+                # view must be gone by now too
+                view.release()
 
     @staticmethod
-    def _extract_raw(src_path: str, dst_path: str, **_):
-        if Utils.should_copy(src_path, dst_path):
-            shutil.copy2(src_path, dst_path)
-            return ExtractionStatus.EXTRACTED
-        return ExtractionStatus.SKIPPED
+    def _slice_chunks(data: memoryview) -> Iterator[memoryview]:
+        chunk_size = AssetManager.CHUNK_SIZE
+        for start in range(0, len(data), chunk_size):
+            yield data[start : start + chunk_size]
 
     @staticmethod
-    def _extract_from_zip(src_path: str, dst_path: str, entry: Element, original: str):
-        virtual_name = entry.get("virtual")
-        if not virtual_name:
-            logging.error(f"Virtual name not found for entry: {original}")
-            return ExtractionStatus.ERROR
+    def _inflate_chunks(data: memoryview) -> Iterator[bytes]:
+        # bounded output per call, a highly compressed member never
+        # inflates into one huge buffer
+        chunk_size = AssetManager.CHUNK_SIZE
+        inflater = zlib.decompressobj(-zlib.MAX_WBITS)
+        for compressed in AssetManager._slice_chunks(data):
+            while compressed:
+                yield inflater.decompress(compressed, chunk_size)
+                compressed = inflater.unconsumed_tail
+        yield inflater.flush()
 
-        with zipfile.ZipFile(src_path, "r") as zf:
-            raw_bytes = zf.read(virtual_name)
+    @staticmethod
+    def _checked_chunks(
+        info: zipfile.ZipInfo, chunks: Iterable[Chunk]
+    ) -> Iterator[Chunk]:
+        # same CRC-32 check ZipExtFile does, once the last chunk is read
+        crc = size = 0
+        for chunk in chunks:
+            crc = zlib.crc32(chunk, crc)
+            size += len(chunk)
+            yield chunk
+        if crc != info.CRC or size != info.file_size:
+            raise zipfile.BadZipFile(f"Bad CRC-32 for file {info.filename!r}")
+
+    @staticmethod
+    def _member_data(pack: memoryview, info: zipfile.ZipInfo) -> Optional[memoryview]:
+        """Compressed bytes of `info` inside the mapped zip, None if unsupported."""
+        if info.flag_bits & 0x1:  # encrypted member
+            return None
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            return None
+        header = ZIP_LOCAL_HEADER.unpack_from(pack, info.header_offset)
+        if header[_LH_SIGNATURE] != ZIP_LOCAL_SIGNATURE:
+            raise zipfile.BadZipFile(f"Bad magic number for file header: {info.filename}")
+        start = (
+            info.header_offset
+            + ZIP_LOCAL_HEADER.size
+            + header[_LH_NAME_LENGTH]
+            + header[_LH_EXTRA_LENGTH]
+        )
+        data = pack[start : start + info.compress_size]
+        if len(data) != info.compress_size:
+            raise zipfile.BadZipFile(f"Truncated file data: {info.filename}")
+        return data
+
+    @staticmethod
+    def _stream_chunks(zf: zipfile.ZipFile, info: zipfile.ZipInfo) -> Iterator[bytes]:
+        # ZipExtFile checks the CRC itself
+        with zf.open(info) as member:
+            while chunk := member.read(AssetManager.CHUNK_SIZE):
+                yield chunk
+
+    @staticmethod
+    def _same_chunks(chunks: Iterable[Chunk], dst_path: str) -> bool:
+        with open(dst_path, "rb", buffering=0) as f:
+            for chunk in chunks:
+                data = f.read(len(chunk))
+                # startswith is a memcmp against the chunk, even a memoryview
+                if len(data) != len(chunk) or not data.startswith(chunk):
+                    return False
+            return not f.read(1)
 
-        if Utils.should_write(raw_bytes, dst_path):
-            with open(dst_path, "wb") as f:
-                f.write(raw_bytes)
-            return ExtractionStatus.EXTRACTED
+    @staticmethod
+    def _write_chunks(
+        open_chunks: Callable[[], Iterable[Chunk]],
+        dst_path: str,
+        size: int,
+        stat_src: Optional[str] = None,
+    ) -> ExtractResult:
+        """
+        Writes the chunks of `open_chunks()` to `dst_path`, unless it already
+        holds exactly them. Only one chunk is in memory at a time.
+        `stat_src`: copy its permission bits and times like `shutil.copy2`.
+        """
+        if os.path.exists(dst_path) and os.path.getsize(dst_path) == size:
+            if AssetManager._same_chunks(open_chunks(), dst_path):
+                return ExtractionStatus.SKIPPED, FileRecord.of_file(dst_path)
 
-        return ExtractionStatus.SKIPPED
+        tmp_path = dst_path + ".tmp"
+        try:
+            with open(tmp_path, "wb") as f:
+                for chunk in open_chunks():
+                    f.write(chunk)
+            if stat_src is not None:
+                shutil.copystat(stat_src, tmp_path)
+            os.replace(tmp_path, dst_path)
+        except BaseException:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            raise
+        return ExtractionStatus.EXTRACTED, FileRecord.of_file(dst_path)
 
     @staticmethod
-    def _extract_from_encrypted_zip(
-        src_path: str, dst_path: str, entry: Element, original: str
+    def _extract_raw(src_path: str, jobs: List[ExtractJob]):
+        # raw packs hold a single file each
+        results = []
+        with AssetManager._map_file(src_path) as data:
+            for _, _, dst_path in jobs:
+                results.append(
+                    AssetManager._write_chunks(
+                        lambda: AssetManager._slice_chunks(data),
+                        dst_path,
+                        len(data),
+                        stat_src=src_path,
+                    )
+                )
+        return results
+
+    @staticmethod
+    def _extract_members(
+        zf: zipfile.ZipFile,
+        jobs: List[ExtractJob],
+        pack: Optional[memoryview] = None,
     ):
-        virtual_name = entry.get("virtual")
-        if not virtual_name:
-            logging.error(f"Virtual name not found for entry: {original}")
-            return ExtractionStatus.ERROR
+        """
+        `pack`: the mapped archive, stored and deflated members are then read
+        straight from it. Without it members are streamed through `zf`.
+        """
+        results = []
+        for virtual_name, original, dst_path in jobs:
+            if not virtual_name:
+                logging.error(f"Virtual name not found for entry: {original}")
+                results.append((ExtractionStatus.ERROR, None))
+                continue
 
-        with open(src_path, "rb") as f:
-            encrypted_data = f.read()
+            try:
+                info = zf.getinfo(virtual_name)
+                data = None if pack is None else AssetManager._member_data(pack, info)
+
+                if data is None:
+                    open_chunks = lambda: AssetManager._stream_chunks(zf, info)
+                # the default keeps `data` narrowed to a memoryview
+                elif info.compress_type == zipfile.ZIP_STORED:
+                    open_chunks = lambda data=data: AssetManager._checked_chunks(
+                        info, AssetManager._slice_chunks(data)
+                    )
+                else:
+                    open_chunks = lambda data=data: AssetManager._checked_chunks(
+                        info, AssetManager._inflate_chunks(data)
+                    )
+
+                results.append(
+                    AssetManager._write_chunks(open_chunks, dst_path, info.file_size)
+                )
 
-        decrypted_data = Crypt.decrypt(encrypted_data)
+            except KeyError as e:
+                logging.exception(f"Failed to extract {original}: {e}")
+                results.append((ExtractionStatus.ERROR, None))
+            except Exception as e:
+                logging.exception(f"{original} catch an unknown error: {e}")
+                results.append((ExtractionStatus.ERROR, None))
+        return results
 
-        with io.BytesIO(decrypted_data) as stream:
-            with zipfile.ZipFile(stream, "r") as zf:
-                raw_bytes = zf.read(virtual_name)
+    @staticmethod
+    def _extract_from_zip(src_path: str, jobs: List[ExtractJob]):
+        # the central directory is read through the file, member data from the map
+        with zipfile.ZipFile(src_path, "r") as zf:
+            with AssetManager._map_file(src_path) as pack:
+                return AssetManager._extract_members(zf, jobs, pack)
 
-        if Utils.should_write(raw_bytes, dst_path):
-            with open(dst_path, "wb") as f:
-                f.write(raw_bytes)
-            return ExtractionStatus.EXTRACTED
+    @staticmethod
+    def _extract_from_encrypted_zip(src_path: str, jobs: List[ExtractJob]):
+        # decrypted while reading, only the members' ranges are ever decrypted
+        with Crypt.open_decrypted(src_path) as stream:
+            with zipfile.ZipFile(stream, "r") as zf:
+                return AssetManager._extract_members(zf, jobs)
 
-        return ExtractionStatus.SKIPPED
+    @staticmethod
+    def _run_pack_jobs(
+        src_path: str, method: str, jobs: List[ExtractJob]
+    ) -> List[ExtractResult]:
+        """
+        Extracts `jobs` from one pack and returns their results in order.
+        Runs in a worker thread or process, so it only touches the file system.
+        """
+        handler = AssetManager._EXTRACTION_METHODS[method]
+        try:
+            return handler(src_path, jobs)
+        except (FileNotFoundError, zipfile.BadZipFile) as e:
+            logging.exception(f"Failed to extract from {src_path}: {e}")
+        except Exception as e:
+            logging.exception(f"{src_path} catch an unknown error: {e}")
+        return [(ExtractionStatus.ERROR, None)] * len(jobs)
 
-    def _extract_entry(self, entry: Element, original: str, pack: str):
-        method = entry.get("method")
+    def _prepare_pack_jobs(
+        self, pack: str, method: Optional[str], items: List[Tuple[Entry, str]]
+    ) -> Optional[Tuple[str, List[ExtractJob]]]:
         if method is None:
-            logging.error(f"Method not found for entry: {original}")
-            return ExtractionStatus.ERROR
-
-        handler = self._extraction_methods.get(method)
-        if handler is None:
-            logging.error(f"Unknown extraction method '{method}' for entry: {original}")
-            return ExtractionStatus.ERROR
+            for _, original in items:
+                logging.error(f"Method not found for entry: {original}")
+            return None
+
+        if method not in self._EXTRACTION_METHODS:
+            for _, original in items:
+                logging.error(
+                    f"Unknown extraction method '{method}' for entry: {original}"
+                )
+            return None
 
         src_path = os.path.join(self.package_path, pack)
         if not os.path.exists(src_path):
             logging.exception(f"Source file not found: {src_path}")
-            return ExtractionStatus.ERROR
+            return None
 
-        dst_path = os.path.join(self.data_path, original)
-        os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+        jobs: List[ExtractJob] = []
+        for entry, original in items:
+            dst_path = os.path.join(self.data_path, original)
+            os.makedirs(os.path.dirname(dst_path), exist_ok=True)
+            jobs.append((entry.get("virtual"), original, dst_path))
+        return src_path, jobs
 
-        try:
-            result = handler(src_path, dst_path, entry=entry, original=original)
-            if result != ExtractionStatus.ERROR:
-                self._edit_index(entry, original)
-            return result
-
-        except (FileNotFoundError, zipfile.BadZipFile, KeyError) as e:
-            logging.exception(f"Failed to extract {original} from {src_path}: {e}")
-        except Exception as e:
-            logging.exception(f"{original} catch an unknown error: {e}")
-
-        return ExtractionStatus.ERROR
+    _EXTRACTION_METHODS: Dict[str, Callable[[str, List[ExtractJob]], List[ExtractResult]]] = {
+        "raw": _extract_raw,
+        "zip": _extract_from_zip,
+        "encrypted_zip": _extract_from_encrypted_zip,
+    }
 
     def extract_entries(
         self, original_text: Union[str, Set[str]], match_mode: str = "prefix"
@@ -248,41 +527,20 @@ class AssetManager:
         self._backup_index()
 
         logging.info("Searching for extract...")
-        entries_to_extract: List[Tuple[Element, str, str]] = []
+        packs_to_extract: DefaultDict[
+            Tuple[str, Optional[str]], List[Tuple[Entry, str]]
+        ] = defaultdict(list)
 
         counters = {status: 0 for status in ExtractionStatus}
-        index_modified = False
-
-        # # use xpath, but not faster so much and not cache, second run will slower a lot
-        # if match_mode == "exact":
-        #     for t in list(targets):
-        #         found = self._xpath_entry_by_original(self.index_root, target=t)
-        #         if found:
-        #             entry = found[0]
-        #             pack = entry.get("pack")
-        #             if pack:
-        #                 if os.path.basename(pack) != os.path.basename(t):
-        #                     entries_to_extract.append((entry, t, pack))
-        #                 else:
-        #                     logging.debug(f"{t} already extracted")
-        #             targets.discard(t)
-        #
-        #     # if targets:  # some not found
-        #     #     logging.warning(f"{len(targets)} files not found in index: {targets}")
-        #
-        # elif match_mode == "prefix":
-        #     for t in targets:
-        #         found = self._xpath_entry_startswith_original(self.index_root, target=t)
-        #         for entry in found:
-        #             original = entry.get("original")
-        #             pack = entry.get("pack")
-        #             if original and pack:
-        #                 if os.path.basename(pack) != os.path.basename(original):
-        #                     entries_to_extract.append((entry, original, pack))
-        #                 else:
-        #                     logging.debug(f"{original} already extracted")
-
-        for entry in self.index_root:
+
+        if match_mode == "exact":
+            candidates = [
+                entry for entry in map(self.index.find, targets) if entry is not None
+            ]
+        else:
+            candidates = self.index.find_prefix(targets)
+
+        for entry in candidates:
             original = entry.get("original")
             if original is None:
                 continue
@@ -292,58 +550,62 @@ class AssetManager:
                 continue
 
             # normalized_original = os.path.normpath(original).lower()
-            normalized_original = original.replace("\\", "/")
+            normalized_original = IndexTable.normalize(original)
 
-            if os.path.basename(pack) == os.path.basename(original):
-                if normalized_original in targets:
-                    logging.debug(f"{original} already extracted")
-                continue  # already extracted
+            extracted = os.path.basename(pack) == os.path.basename(original)
+            if extracted and normalized_original in targets:
+                logging.debug(f"{original} already extracted")
 
-            match = (
-                any(normalized_original.startswith(p) for p in targets)
-                if match_mode == "prefix"
-                else normalized_original in targets
-            )
+            if match_mode == "exact":
+                targets.discard(normalized_original)
 
-            if not match:
+            if extracted:
+                continue  # already extracted
+
+            # unchanged entry and untouched file: nothing to read or compare
+            dst_path = os.path.join(self.data_path, original)
+            if self._manifest.is_current(normalized_original, entry, dst_path):
+                self._edit_index(entry, original)
+                counters[ExtractionStatus.SKIPPED] += 1
+                logging.debug(f"{original} up to date, path updated")
                 continue
 
-            if match_mode == "exact":
-                targets.discard(normalized_original)
+            # group by pack, so each archive is opened and decrypted once
+            packs_to_extract[(pack, entry.get("method"))].append((entry, original))
+
+        executor_cls = self.EXECUTORS[self.executor]
+        with executor_cls(max_workers=self.max_workers) as executor:
+            futures = {}
+            for (pack, method), items in packs_to_extract.items():
+                prepared = self._prepare_pack_jobs(pack, method, items)
+                if prepared is None:
+                    continue
+                src_path, jobs = prepared
+                future = executor.submit(
+                    AssetManager._run_pack_jobs, src_path, method, jobs
+                )
+                futures[future] = items
 
-            entries_to_extract.append((entry, original, pack))
-
-            # # no multithreading version
-            # status = self._extract_entry(entry, original, pack)
-            # if status != ExtractionStatus.ERROR:
-            #     counters[status] += 1
-            #     index_modified = True
-            #     if status == ExtractionStatus.EXTRACTED:
-            #         logging.info(f"Extracted {original}")
-            #     else:
-            #         logging.debug(f"{original} not changed, path updated")
-
-            # in exact mode, exit early when done
-            if match_mode == "exact" and not targets:
-                break
-
-        with ThreadPoolExecutor() as executor:
-            futures = {
-                # *item: unpack the tuple
-                executor.submit(self._extract_entry, *item): item[1]
-                for item in entries_to_extract
-            }
             for future in as_completed(futures):
-                original = futures[future]
-                status = future.result()
-                if status != ExtractionStatus.ERROR:
+                # the index is only edited here, workers never see the entries
+                for (entry, original), (status, record) in zip(
+                    futures[future], future.result()
+                ):
+                    normalized_original = IndexTable.normalize(original)
+                    if status == ExtractionStatus.ERROR or record is None:
+                        self._manifest.discard(normalized_original)
+                        continue
+                    # recorded against the entry as it is before the path edit
+                    self._manifest.update(normalized_original, entry, record)
+                    self._edit_index(entry, original)
                     counters[status] += 1
-                    index_modified = True
                     if status == ExtractionStatus.EXTRACTED:
                         logging.info(f"Extracted {original}")
                     else:
                         logging.debug(f"{original} not changed, path updated")
 
+        self._manifest.save()
+
         extracted_count = counters[ExtractionStatus.EXTRACTED]
         identical = counters[ExtractionStatus.SKIPPED]
 
@@ -355,8 +617,8 @@ class AssetManager:
         else:
             logging.info(f"{extracted_count} entries extracted.")
 
-        if index_modified:
-            self._save_index(self.index_root)
+        if self.index.is_dirty:
+            self._save_index(self.index)
             if identical > 0:
                 logging.info(
                     f"{identical} identical entries skipped; their path updated to 'data'."
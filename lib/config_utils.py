@@ -1,9 +1,11 @@
 import configparser
 import os
-from typing import Optional
+from typing import Optional, Tuple
 
 CONFIG_FILENAME = "troubletool_config.ini"
 AUTO_EXTRACT_FILES = "CEGUI/datafiles/lua_scripts, script, stage, xml"
+EXTRACT_EXECUTOR = "thread"
+XML_PATCH_FORMAT = "py"
 
 
 def _get_config() -> configparser.ConfigParser:
@@ -34,6 +36,29 @@ def _get_config() -> configparser.ConfigParser:
         config.set("ExtractFiles", "auto", AUTO_EXTRACT_FILES)
         is_modified = True
 
+    if not config.has_section("Extraction"):
+        config.add_section("Extraction")
+        is_modified = True
+
+    # thread or process
+    if not config.has_option("Extraction", "executor"):
+        config.set("Extraction", "executor", EXTRACT_EXECUTOR)
+        is_modified = True
+
+    # empty: let the executor decide
+    if not config.has_option("Extraction", "workers"):
+        config.set("Extraction", "workers", "")
+        is_modified = True
+
+    if not config.has_section("Patches"):
+        config.add_section("Patches")
+        is_modified = True
+
+    # py or json, what create patch writes for xml and stage files
+    if not config.has_option("Patches", "xml_format"):
+        config.set("Patches", "xml_format", XML_PATCH_FORMAT)
+        is_modified = True
+
     if is_modified:
         if not os.path.exists(CONFIG_FILENAME):
             dirname = os.path.dirname(CONFIG_FILENAME)
@@ -108,6 +133,26 @@ def load_extract_files() -> str:
     )
 
 
+def load_extraction_settings() -> Tuple[str, Optional[int]]:
+    """
+    Returns (executor, workers) for AssetManager extraction.
+    workers is None when not set or not a positive number.
+    """
+    config = _get_config()
+    executor = config.get("Extraction", "executor", fallback=EXTRACT_EXECUTOR).strip()
+    workers = config.get("Extraction", "workers", fallback="").strip()
+    if not workers.isdigit() or int(workers) < 1:
+        return executor or EXTRACT_EXECUTOR, None
+    return executor or EXTRACT_EXECUTOR, int(workers)
+
+
+def load_xml_patch_format() -> str:
+    """Returns "py" or "json", the patch format create patch uses for xml and stage files."""
+    config = _get_config()
+    xml_format = config.get("Patches", "xml_format", fallback=XML_PATCH_FORMAT).strip().lower()
+    return xml_format if xml_format in ("py", "json") else XML_PATCH_FORMAT
+
+
 #     # for return default value if not found
 #     return config.get("Paths", "troubleshooter", fallback=None)
 #
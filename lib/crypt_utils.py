@@ -1,4 +1,5 @@
-from typing import Final
+import io
+from typing import BinaryIO, Final
 
 from cryptography.hazmat.backends import default_backend  # type: ignore
 from cryptography.hazmat.primitives import padding  # type: ignore
@@ -169,6 +170,50 @@ class Crypt:
         # except ValueError as e:
         #     raise ValueError(f"Error unpadding decrypted data (PKCS7): {e}. Data might be corrupted or key/IV is incorrect.")
 
+    @staticmethod
+    def open_decrypted(file_path: str, buffer_size: int = 64 * 1024) -> io.BufferedReader:
+        """
+        Opens an encrypted file as a buffered, seekable stream of plaintext.
+        Only the ranges actually read are decrypted, so memory use is bound
+        by `buffer_size` instead of the file size. Like `decrypt`, the stream
+        still ends with the padding added before encryption.
+
+        Args:
+            file_path (str): Path to the AES-CBC encrypted file.
+            buffer_size (int): Read buffer size in bytes.
+
+        Returns:
+            io.BufferedReader: A read-only binary stream of the plaintext.
+        """
+        f = open(file_path, "rb")
+        try:
+            return io.BufferedReader(DecryptReader(f), buffer_size)
+        except Exception:
+            f.close()
+            raise
+
+    @staticmethod
+    def open_encrypted(file_path: str, buffer_size: int = 64 * 1024) -> io.BufferedWriter:
+        """
+        Opens `file_path` for writing as a stream that encrypts on the fly.
+        Closing the stream applies the same PKCS7 padding as `encrypt`, so
+        writing data in any number of pieces gives the same bytes as
+        `encrypt(data)`.
+
+        Args:
+            file_path (str): Destination of the ciphertext.
+            buffer_size (int): Write buffer size in bytes.
+
+        Returns:
+            io.BufferedWriter: A write-only binary stream.
+        """
+        f = open(file_path, "wb")
+        try:
+            return io.BufferedWriter(EncryptWriter(f), buffer_size)
+        except Exception:
+            f.close()
+            raise
+
     @staticmethod
     def pad(data: bytes) -> bytes:
         """
@@ -190,22 +235,42 @@ class Crypt:
         return data
 
     @staticmethod
-    def unpad(xml_bytes: bytes) -> bytearray:
+    def padding_start(data: bytes, chunk_size: int = 4096) -> int:
+        """
+        Returns the offset where the trailing run of null bytes starts.
+        Scans backwards with native `rstrip` on small chunks, so the cost
+        follows the padding length, not the data length.
         """
-        Unpads the given data using PKCS7 padding.
-        This is a simple wrapper around the PKCS7 unpadding function.
+        view = memoryview(data)
+        end = len(view)
+        while end > 0:
+            start = max(0, end - chunk_size)
+            stripped = bytes(view[start:end]).rstrip(b"\0")
+            if stripped:
+                return start + len(stripped)
+            end = start
+        return 0
+
+    @staticmethod
+    def unpad(xml_bytes: bytes, strip: bool = False) -> bytearray | memoryview:
+        """
+        Removes the trailing null padding added by `pad`.
 
         Args:
-            data (bytes): The data to be unpadded.
+            xml_bytes (bytes): The decrypted data.
+            strip (bool): If True, return a zero-copy view without the padding,
+                          which lxml can parse directly. Otherwise return one
+                          mutable copy with the padding replaced by spaces.
 
         Returns:
-            str: The padded data.
+            bytearray | memoryview: The unpadded data.
         """
-        i = len(xml_bytes) - 1
-        data = bytearray(xml_bytes)  # Convert to bytearray for mutability
-        while i >= 0 and data[i] == 0:
-            data[i] = ord(" ")
-            i -= 1
+        end = Crypt.padding_start(xml_bytes)
+        if strip:
+            return memoryview(xml_bytes)[:end]
+
+        data = bytearray(xml_bytes)
+        data[end:] = b" " * (len(data) - end)
         return data
 
     # @staticmethod
@@ -219,6 +284,143 @@ class Crypt:
     #         raise Exception(f"Error loading TroubleCrypt library: {e}")
 
 
+class DecryptReader(io.RawIOBase):
+    """
+    Read-only, seekable plaintext view of an AES-CBC encrypted file.
+
+    In CBC mode a block only depends on itself and the previous ciphertext
+    block, so any range can be decrypted on its own: read one extra block
+    before the range and use it as the IV. Sequential reads reuse the last
+    ciphertext block instead of seeking back for it.
+    """
+
+    BLOCK_SIZE: Final[int] = 16
+    CHUNK_SIZE: Final[int] = 1024 * 1024
+
+    def __init__(self, fileobj: BinaryIO):
+        super().__init__()
+        self._f = fileobj
+        self._size = fileobj.seek(0, io.SEEK_END)
+        if self._size % self.BLOCK_SIZE:
+            raise ValueError(
+                f"Encrypted data length {self._size} is not a multiple of "
+                f"{self.BLOCK_SIZE} bytes."
+            )
+        self._pos = 0
+        # ciphertext block preceding offset `_chain_offset`
+        self._chain_offset = 0
+        self._chain_iv = Crypt._AES_IV
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_SET:
+            pos = offset
+        elif whence == io.SEEK_CUR:
+            pos = self._pos + offset
+        elif whence == io.SEEK_END:
+            pos = self._size + offset
+        else:
+            raise ValueError(f"Invalid whence: {whence}")
+        if pos < 0:
+            raise ValueError(f"Negative seek position {pos}")
+        self._pos = pos
+        return pos
+
+    def _decrypt_blocks(self, start: int, end: int) -> bytes:
+        """Decrypts ciphertext[start:end]; both offsets are block aligned."""
+        if start == self._chain_offset:
+            iv = self._chain_iv
+        elif start == 0:
+            iv = Crypt._AES_IV
+        else:
+            self._f.seek(start - self.BLOCK_SIZE)
+            iv = self._f.read(self.BLOCK_SIZE)
+
+        self._f.seek(start)
+        ciphertext = self._f.read(end - start)
+
+        decryptor = Cipher(
+            algorithms.AES(Crypt._AES_KEY),
+            modes.CBC(iv),
+            backend=default_backend(),
+        ).decryptor()
+        plaintext = decryptor.update(ciphertext)
+
+        self._chain_offset = end
+        self._chain_iv = ciphertext[-self.BLOCK_SIZE :]
+        return plaintext
+
+    def readinto(self, buffer) -> int:
+        n = min(len(buffer), self._size - self._pos, self.CHUNK_SIZE)
+        if n <= 0:
+            return 0
+
+        block = self.BLOCK_SIZE
+        start = self._pos - self._pos % block
+        end = min(self._size, -(-(self._pos + n) // block) * block)
+        plaintext = self._decrypt_blocks(start, end)
+
+        offset = self._pos - start
+        buffer[:n] = plaintext[offset : offset + n]
+        self._pos += n
+        return n
+
+    def readall(self) -> bytes:
+        chunks = []
+        while chunk := self.read(self.CHUNK_SIZE):
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def close(self):
+        if not self.closed:
+            self._f.close()
+        super().close()
+
+
+class EncryptWriter(io.RawIOBase):
+    """
+    Write-only stream that AES-CBC encrypts everything written to it into
+    `fileobj`. Partial blocks are buffered by the padder; `close` flushes
+    them with PKCS7 padding and closes `fileobj`.
+    """
+
+    def __init__(self, fileobj: BinaryIO):
+        super().__init__()
+        self._f = fileobj
+        self._encryptor = Cipher(
+            algorithms.AES(Crypt._AES_KEY),
+            modes.CBC(Crypt._AES_IV),
+            backend=default_backend(),
+        ).encryptor()
+        self._padder = padding.PKCS7(algorithms.AES.block_size).padder()
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._f.write(self._encryptor.update(self._padder.update(bytes(data))))
+        return len(data)
+
+    def close(self):
+        if not self.closed:
+            try:
+                self._f.write(
+                    self._encryptor.update(self._padder.finalize())
+                    + self._encryptor.finalize()
+                )
+            finally:
+                self._f.close()
+        super().close()
+
+
 # import os, sys, ctypes
 # from typing import Optional, Any
 #
@@ -0,0 +1,94 @@
+import difflib
+import random
+import sys
+import time
+
+from lib.difflib_utils import diff_opcodes
+
+# python -m lib.diff_bench [old.lua new.lua]
+
+
+def make_function(rnd: random.Random, n_lines: int, n_calls: int):
+    # a long game-like function: nested blocks, lots of repeated `end`;
+    # fewer distinct calls mean more repeated lines
+    lines = ["function BigFunction(self, ds, obj)\n"]
+    depth = 1
+    while len(lines) < n_lines:
+        indent = "\t" * depth
+        roll = rnd.random()
+        if roll < 0.2 and depth < 6:
+            lines.append(f"{indent}if obj.Value{rnd.randrange(50)} > {rnd.randrange(9)} then\n")
+            depth += 1
+        elif roll < 0.45 and depth > 1:
+            depth -= 1
+            lines.append("\t" * depth + "end\n")
+        elif roll < 0.55:
+            lines.append(f"{indent}return\n")
+        else:
+            lines.append(f"{indent}ds:Call{rnd.randrange(n_calls)}(obj)\n")
+    while depth > 1:
+        depth -= 1
+        lines.append("\t" * depth + "end\n")
+    lines.append("end\n")
+    return lines
+
+
+def edit(rnd: random.Random, lines, ratio: float):
+    # rewrite about `ratio` of the lines in place, insert and delete some
+    new_lines = list(lines)
+    for _ in range(int(len(lines) * ratio)):
+        pos = rnd.randrange(1, len(new_lines) - 1)
+        roll = rnd.random()
+        if roll < 0.5:
+            new_lines[pos] = f"\tmod:Hook{rnd.randrange(500)}(obj)\n"
+        elif roll < 0.75:
+            new_lines.insert(pos, f"\tmod:Extra{rnd.randrange(500)}()\n")
+        else:
+            del new_lines[pos]
+    return new_lines
+
+
+def timed(func, a, b):
+    start = time.perf_counter()
+    opcodes = func(a, b)
+    elapsed = time.perf_counter() - start
+    # lines in the patch: smaller is a tighter diff
+    changed = sum(i2 - i1 + j2 - j1 for tag, i1, i2, j1, j2 in opcodes if tag != "equal")
+    return elapsed, changed
+
+
+def sequence_matcher(a, b):
+    return difflib.SequenceMatcher(None, a, b).get_opcodes()
+
+
+def compare(name: str, a, b):
+    old, old_changes = timed(sequence_matcher, a, b)
+    new, new_changes = timed(diff_opcodes, a, b)
+    print(
+        f"{name:<32} SequenceMatcher {old:8.3f} s {old_changes:6} lines   "
+        f"diff_opcodes {new:7.3f} s {new_changes:6} lines"
+    )
+
+
+def run():
+    rnd = random.Random(0)
+    for n_lines in (1000, 5000, 20000):
+        for n_calls in (5000, 100, 20):
+            lines = make_function(rnd, n_lines, n_calls)
+            for ratio in (0.01, 0.1, 0.5):
+                compare(
+                    f"{n_lines} lines, {n_calls} calls, {ratio:.0%} edited",
+                    lines,
+                    edit(rnd, lines, ratio),
+                )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) == 3:
+        with open(sys.argv[1], "r", encoding="utf-8") as f:
+            a = f.readlines()
+        with open(sys.argv[2], "r", encoding="utf-8") as f:
+            b = f.readlines()
+        compare("files", a, b)
+    else:
+        run()
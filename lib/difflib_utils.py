@@ -1,5 +1,15 @@
-import difflib
-from typing import List, Dict
+from bisect import bisect_left
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+from lib.utils import Utils
+
+Opcode = Tuple[str, int, int, int, int]
+# (i, j, size): a[i:i + size] == b[j:j + size], like SequenceMatcher
+Match = Tuple[int, int, int]
+
+# Myers past this many edits costs more than it saves, the range is split
+# on unique lines instead, keeping big rewrites near linear
+MYERS_MAX_COST = 256
 
 # diff = tuple(difflib.ndiff(a, b)) # if not cast to list, need to recompute because diff is an iterator
 
@@ -25,13 +35,208 @@ def safe_slice(seq, start, end):
     return seq[max(start, 0): min(end, len(seq))]
 
 
+def _unique_anchors(
+    a: Sequence[int], alo: int, ahi: int, b: Sequence[int], blo: int, bhi: int
+) -> List[Tuple[int, int]]:
+    """
+    Patience diff anchors: lines found exactly once in both ranges, the
+    longest run of them in the same order on both sides.
+    """
+    counts: Dict[int, List[int]] = {}
+    for i in range(alo, ahi):
+        entry = counts.setdefault(a[i], [0, i, 0, -1])
+        entry[0] += 1
+    for j in range(blo, bhi):
+        entry = counts.get(b[j])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = j
+    pairs = [
+        (entry[1], entry[3])
+        for entry in counts.values()
+        if entry[0] == 1 and entry[2] == 1
+    ]
+    if not pairs:
+        return []
+    pairs.sort()
+
+    # longest increasing subsequence of the b side, patience sorting
+    tops: List[int] = []  # smallest b index ending a run of each length
+    top_pair: List[int] = []  # index in pairs of that run end
+    prev: List[int] = []
+    for n, (_, j) in enumerate(pairs):
+        pos = bisect_left(tops, j)
+        if pos == len(tops):
+            tops.append(j)
+            top_pair.append(n)
+        else:
+            tops[pos] = j
+            top_pair[pos] = n
+        prev.append(top_pair[pos - 1] if pos else -1)
+
+    anchors = []
+    n = top_pair[-1]
+    while n != -1:
+        anchors.append(pairs[n])
+        n = prev[n]
+    anchors.reverse()
+    return anchors
+
+
+def _myers_matches(
+    a: Sequence[int], alo: int, ahi: int, b: Sequence[int], blo: int, bhi: int
+) -> Optional[List[Match]]:
+    """
+    Matching lines of the shortest edit script, Myers' O((N+M)D) greedy
+    search. None if it takes more than MYERS_MAX_COST edits.
+    """
+    n = ahi - alo
+    m = bhi - blo
+    max_cost = min(MYERS_MAX_COST, n + m)
+    offset = max_cost + 1
+    v = [0] * (2 * offset + 1)
+    trace = []
+
+    for d in range(max_cost + 1):
+        trace.append(v[:])
+        for k in range(-d, d + 1, 2):
+            if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+                x = v[offset + k + 1]
+            else:
+                x = v[offset + k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[alo + x] == b[blo + y]:
+                x += 1
+                y += 1
+            v[offset + k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+
+    # walk the trace back from the end, collecting the diagonals
+    matches: List[Match] = []
+    x, y = n, m
+    for d in range(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[offset + k - 1] < v[offset + k + 1]):
+            prev_k = k + 1
+        else:
+            prev_k = k - 1
+        prev_x = v[offset + prev_k]
+        prev_y = prev_x - prev_k
+        if d == 0:
+            prev_x = prev_y = 0
+        size = min(x - prev_x, y - prev_y)
+        if size > 0:
+            matches.append((alo + x - size, blo + y - size, size))
+        x, y = prev_x, prev_y
+    matches.reverse()
+    return matches
+
+
+def matching_blocks(a: Sequence[str], b: Sequence[str]) -> List[Match]:
+    """
+    Matching blocks of `a` and `b`, as SequenceMatcher.get_matching_blocks:
+    sorted, adjacent ones merged, ending with (len(a), len(b), 0).
+
+    Common prefix and suffix are matched first, then Myers finds the
+    shortest edit script if it takes at most MYERS_MAX_COST edits. Longer
+    ones are split on the lines unique to both sides (patience diff) and
+    each gap is handled the same way; a gap with no unique line left is
+    one replace.
+    """
+    # compare ints, not strings
+    ids: Dict[str, int] = {}
+    a_ids = [ids.setdefault(line, len(ids)) for line in a]
+    b_ids = [ids.setdefault(line, len(ids)) for line in b]
+
+    found: List[Match] = []
+    stack = [(0, len(a), 0, len(b))]
+    while stack:
+        alo, ahi, blo, bhi = stack.pop()
+
+        start = alo
+        while alo < ahi and blo < bhi and a_ids[alo] == b_ids[blo]:
+            alo += 1
+            blo += 1
+        if alo > start:
+            found.append((start, blo - (alo - start), alo - start))
+        end = ahi
+        while alo < ahi and blo < bhi and a_ids[ahi - 1] == b_ids[bhi - 1]:
+            ahi -= 1
+            bhi -= 1
+        if ahi < end:
+            found.append((ahi, bhi, end - ahi))
+        if alo == ahi or blo == bhi:
+            continue
+
+        matches = _myers_matches(a_ids, alo, ahi, b_ids, blo, bhi)
+        if matches is not None:
+            found.extend(matches)
+            continue
+
+        # too many edits for Myers, split on the unique lines
+        anchors = _unique_anchors(a_ids, alo, ahi, b_ids, blo, bhi)
+        for i, j in anchors:
+            found.append((i, j, 1))
+            stack.append((alo, i, blo, j))
+            alo, blo = i + 1, j + 1
+        if anchors:
+            stack.append((alo, ahi, blo, bhi))
+
+    found.sort()
+    merged: List[Match] = []
+    for i, j, size in found:
+        if merged:
+            last_i, last_j, last_size = merged[-1]
+            if last_i + last_size == i and last_j + last_size == j:
+                merged[-1] = (last_i, last_j, last_size + size)
+                continue
+        merged.append((i, j, size))
+    merged.append((len(a), len(b), 0))
+    return merged
+
+
+def diff_opcodes(a: Sequence[str], b: Sequence[str]) -> List[Opcode]:
+    """Opcodes turning `a` into `b`, as SequenceMatcher.get_opcodes."""
+    opcodes: List[Opcode] = []
+    i = j = 0
+    for ai, bj, size in matching_blocks(a, b):
+        if i < ai and j < bj:
+            opcodes.append(("replace", i, ai, j, bj))
+        elif i < ai:
+            opcodes.append(("delete", i, ai, j, bj))
+        elif j < bj:
+            opcodes.append(("insert", i, ai, j, bj))
+        i, j = ai + size, bj + size
+        if size:
+            opcodes.append(("equal", ai, i, bj, j))
+    return opcodes
+
+
+def _is_ambiguous(text: str, needle: str) -> bool:
+    """True if `needle` is found more than once in `text`, as replace_code looks it up."""
+    needle = Utils.remove_blank_lines(needle)
+    first = text.find(needle)
+    return first != -1 and text.find(needle, first + 1) != -1
+
+
 # need remove empty lines in lua files to make it work
-def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
+def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, Any]]:
     """
     Compares two lists of strings and generates a structured list of differences.
 
-    This function uses difflib.SequenceMatcher to find and categorize the
-    differences between two sequences of strings (lines of text).
+    This function uses diff_opcodes (Myers diff, patience diff past
+    MYERS_MAX_COST edits) to find and categorize the differences between two
+    sequences of strings (lines of text). Unlike difflib.SequenceMatcher it
+    stays near linear on long functions full of repeated lines like `end`.
+    Its hunks are tight, so context lines are added until each old block is
+    found only once in `a`.
 
     Args:
         a: A list of strings representing the original text.
@@ -39,17 +244,25 @@ def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
 
     Returns:
         A list of dictionaries, where each dictionary represents a change
-        and has a 'type' key ('delete', or 'replace').
+        and has a 'type' key ('delete', or 'replace') and a 'line' key, the
+        index in `a` where the old block starts.
         Inserts are normalized into "replace" with context.
     """
     result = []
-    matcher = difflib.SequenceMatcher(None, a, b)
     prev_context = ""
+    a_text = "".join(a)
+    # "type", "old", "new" (not for deletes) as str, "line" as int
+    entry: Dict[str, Any]
 
-    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+    for tag, i1, i2, j1, j2 in diff_opcodes(a, b):
         # if tag == "equal":
         #     if i2 > i1:
         #         prev_context = a[i2 - 1]
+        if tag == "equal":
+            continue
+
+        # lines of `a` taken on each side of the change
+        context = 1
 
         # include prev line + next line to prevent short code like `end`
         if tag == "delete":
@@ -61,17 +274,17 @@ def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
                 old_block = prev_context + old_block + next_context
                 new_block = prev_context + next_context
 
-                result.append({
+                entry = {
                     "type": "replace",
                     "old": old_block,
                     "new": new_block
-                })
-                continue
-
-            result.append({
-                "type": "delete",
-                "old": old_block
-            })
+                }
+            else:
+                context = 0
+                entry = {
+                    "type": "delete",
+                    "old": old_block
+                }
             # result.append(f'removed """{old_block}"""')
 
         elif tag == "insert":
@@ -84,15 +297,15 @@ def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
             # old_block = prev_context + next_context
             # new_block = prev_context + "".join(b[j1:j2]) + next_context
 
-            result.append({
+            entry = {
                 "type": "replace",
                 "old": old_block,
                 "new": new_block,
-            })
+            }
             # result.append(f'insert, replace "{old_block}" with "{new_block}"')
 
         # include prev line + next line to prevent short code like `end`
-        elif tag == "replace":
+        else:
             new_block = "".join(b[j1:j2])
 
             if len(new_block.strip()) < 33:
@@ -101,14 +314,15 @@ def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
                 old_block = "".join(safe_slice(a, i1 - 1, i2 + 1)).rstrip()
                 new_block = prev_context + new_block + next_context
             else:
+                context = 0
                 old_block = "".join(a[i1:i2]).rstrip()
                 new_block = new_block.rstrip()
 
-            result.append({
+            entry = {
                 "type": "replace",
                 "old": old_block,
                 "new": new_block
-            })
+            }
 
             # old_lines = [line.rstrip("\n") for line in a[i1:i2]]
             # new_lines = [line.rstrip("\n") for line in b[j1:j2]]
@@ -125,6 +339,21 @@ def summarize_diff(a: List[str], b: List[str]) -> List[Dict[str, str]]:
             # new_block = "\n".join(f'"{nl}"' for nl in new_lines)
             # result.append(f"replaced:\n{old_block}\nwith:\n{new_block}")
 
+        # a block found more than once may be changed at the wrong place
+        while _is_ambiguous(a_text, entry["old"]) and (
+            i1 - context > 0 or i2 + context < len(a)
+        ):
+            context += 1
+            prev_lines = "".join(safe_slice(a, i1 - context, i1))
+            next_lines = "".join(safe_slice(a, i2, i2 + context))
+            entry = {
+                "type": "replace",
+                "old": (prev_lines + "".join(a[i1:i2]) + next_lines).rstrip(),
+                "new": (prev_lines + "".join(b[j1:j2]) + next_lines).rstrip(),
+            }
+        entry["line"] = max(i1 - context, 0)
+        result.append(entry)
+
     return result
 
 
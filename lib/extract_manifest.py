@@ -0,0 +1,96 @@
+import json
+import os
+from typing import Dict, List, NamedTuple, Optional
+
+import lib.ui_logger as logging
+from lib.index_table import Entry
+
+# bump when the layout below changes, old manifests are then ignored
+_VERSION = 1
+
+
+class FileRecord(NamedTuple):
+    """Size and mtime of one extracted file."""
+
+    size: int
+    mtime_ns: int
+
+    @classmethod
+    def of_file(cls, file_path: str) -> "FileRecord":
+        stat = os.stat(file_path)
+        return cls(stat.st_size, stat.st_mtime_ns)
+
+
+class ExtractManifest:
+    """
+    What was extracted into Data/ and from which index entry. A file whose
+    entry and on-disk size/mtime still match its record is up to date, so
+    re-extracting it can be skipped without reading either side.
+    """
+
+    # index entry attributes that identify the extracted content
+    SOURCE_KEYS = ("pack", "method", "virtual", "size", "csize")
+
+    def __init__(self, manifest_file: str):
+        self.manifest_file = manifest_file
+        self._files: Optional[Dict[str, dict]] = None
+        self._changed = False
+
+    @property
+    def files(self) -> Dict[str, dict]:
+        if self._files is None:
+            self._files = self._read()
+        return self._files
+
+    def _read(self) -> Dict[str, dict]:
+        try:
+            with open(self.manifest_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return {}
+        except (OSError, ValueError) as e:
+            logging.warning(f"Extract manifest unreadable, ignored: {e}")
+            return {}
+        if not isinstance(data, dict) or data.get("version") != _VERSION:
+            return {}
+        return data.get("files", {})
+
+    def save(self):
+        if not self._changed:
+            return
+        tmp_file = self.manifest_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.manifest_file), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump({"version": _VERSION, "files": self.files}, f)
+            os.replace(tmp_file, self.manifest_file)
+            self._changed = False
+        except OSError as e:
+            logging.warning(f"Can't write extract manifest {self.manifest_file}: {e}")
+
+    @classmethod
+    def source_of(cls, entry: Entry) -> List[Optional[str]]:
+        return [entry.get(key) for key in cls.SOURCE_KEYS]
+
+    def is_current(self, original: str, entry: Entry, dst_path: str) -> bool:
+        """True if `dst_path` is still what `entry` extracted to, by metadata only."""
+        record = self.files.get(original)
+        if record is None or record.get("source") != self.source_of(entry):
+            return False
+        try:
+            stat = os.stat(dst_path)
+        except OSError:
+            return False
+        return stat.st_size == record["size"] and stat.st_mtime_ns == record["mtime_ns"]
+
+    def update(self, original: str, entry: Entry, record: FileRecord):
+        self.files[original] = {
+            "size": record.size,
+            "mtime_ns": record.mtime_ns,
+            "source": self.source_of(entry),
+        }
+        self._changed = True
+
+    def discard(self, original: str):
+        if self.files.pop(original, None) is not None:
+            self._changed = True
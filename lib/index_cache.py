@@ -0,0 +1,163 @@
+import os
+import struct
+from typing import List, NamedTuple, Optional
+
+import lib.ui_logger as logging
+from lib.index_table import Entry, IndexTable
+from lib.utils import Utils
+
+# bump when the layout below changes, old caches are then ignored
+_MAGIC = b"TTIDX\x01"
+_HEADER = struct.Struct("<QQ?")
+_LENGTH = struct.Struct("<I")
+# XML attribute values can't contain NUL or \x01, so they are safe separators
+_SEP = "\0"
+_MISSING = "\x01"
+
+
+class IndexFingerprint(NamedTuple):
+    size: int
+    mtime_ns: int
+    digest: bytes
+
+    @classmethod
+    def of(cls, file_path: str) -> "IndexFingerprint":
+        stat = os.stat(file_path)
+        return cls(stat.st_size, stat.st_mtime_ns, Utils.file_hash(file_path))
+
+    def to_text(self) -> str:
+        return f"{self.size} {self.mtime_ns} {self.digest.hex()}"
+
+    @classmethod
+    def from_text(cls, text: str) -> Optional["IndexFingerprint"]:
+        try:
+            size, mtime_ns, digest = text.split()
+            return cls(int(size), int(mtime_ns), bytes.fromhex(digest))
+        except ValueError:
+            return None
+
+
+class IndexCache:
+    """
+    Persistent, decrypted copy of Package/index keyed by the index file
+    fingerprint (size, mtime, hash). Entries are stored column by column:
+    one NUL-joined utf-8 blob per attribute name, so loading is a handful
+    of `split` calls instead of decrypt + unzip + XML parse.
+    """
+
+    def __init__(self, cache_file: str):
+        self.cache_file = cache_file
+
+    def load(self, fingerprint: IndexFingerprint) -> Optional[IndexTable]:
+        try:
+            with open(self.cache_file, "rb") as f:
+                data = f.read()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            logging.warning(f"Can't read index cache {self.cache_file}: {e}")
+            return None
+
+        try:
+            return self._decode(data, fingerprint)
+        except (struct.error, UnicodeDecodeError, ValueError) as e:
+            logging.warning(f"Index cache corrupted, ignored: {e}")
+            return None
+
+    def save(self, fingerprint: IndexFingerprint, table: IndexTable):
+        data = self._encode(fingerprint, table)
+        tmp_file = self.cache_file + ".tmp"
+        try:
+            os.makedirs(os.path.dirname(self.cache_file), exist_ok=True)
+            with open(tmp_file, "wb") as f:
+                f.write(data)
+            os.replace(tmp_file, self.cache_file)
+        except OSError as e:
+            logging.warning(f"Can't write index cache {self.cache_file}: {e}")
+
+    @staticmethod
+    def _encode(fingerprint: IndexFingerprint, table: IndexTable) -> bytes:
+        columns: List[str] = []
+        seen = set()
+        for entry in table.entries:
+            for name in entry:
+                if name not in seen:
+                    seen.add(name)
+                    columns.append(name)
+
+        blobs = [
+            fingerprint.digest,
+            table.tag.encode("utf-8"),
+            _SEP.join(v for item in table.attrib.items() for v in item).encode("utf-8"),
+            _SEP.join(columns).encode("utf-8"),
+        ]
+        for name in columns:
+            blobs.append(
+                _SEP.join(entry.get(name, _MISSING) for entry in table.entries).encode(
+                    "utf-8"
+                )
+            )
+
+        parts = [
+            _MAGIC,
+            _HEADER.pack(fingerprint.size, fingerprint.mtime_ns, table.zipped),
+            _LENGTH.pack(len(table.entries)),
+        ]
+        for blob in blobs:
+            parts.append(_LENGTH.pack(len(blob)))
+            parts.append(blob)
+        return b"".join(parts)
+
+    @staticmethod
+    def _decode(data: bytes, fingerprint: IndexFingerprint) -> Optional[IndexTable]:
+        if not data.startswith(_MAGIC):
+            return None
+        offset = len(_MAGIC)
+        size, mtime_ns, zipped = _HEADER.unpack_from(data, offset)
+        if size != fingerprint.size or mtime_ns != fingerprint.mtime_ns:
+            return None
+        offset += _HEADER.size
+        (count,) = _LENGTH.unpack_from(data, offset)
+        offset += _LENGTH.size
+
+        view = memoryview(data)
+
+        def next_blob() -> bytes:
+            nonlocal offset
+            (length,) = _LENGTH.unpack_from(data, offset)
+            offset += _LENGTH.size
+            blob = view[offset : offset + length]
+            if len(blob) != length:
+                raise ValueError("truncated cache")
+            offset += length
+            return bytes(blob)
+
+        def split(blob: bytes) -> List[str]:
+            # an empty blob is "no values", never a single empty string
+            return blob.decode("utf-8").split(_SEP) if blob else []
+
+        if next_blob() != fingerprint.digest:
+            return None
+
+        tag = next_blob().decode("utf-8")
+        attrib_items = split(next_blob())
+        attrib = dict(zip(attrib_items[::2], attrib_items[1::2]))
+        columns = split(next_blob())
+
+        # a column with one empty value is also an empty blob
+        values = [
+            split(next_blob()) if count > 1 else [next_blob().decode("utf-8")]
+            for _ in columns
+        ]
+        if any(len(column) != count for column in values):
+            raise ValueError("column length mismatch")
+
+        if any(_MISSING in column for column in values):
+            entries: List[Entry] = [
+                {k: v for k, v in zip(columns, row) if v != _MISSING}
+                for row in zip(*values)
+            ]
+        else:
+            entries = [dict(zip(columns, row)) for row in zip(*values)]
+
+        return IndexTable(tag, attrib, entries, zipped)
@@ -1,4 +1,5 @@
-import os, io, zipfile
+import os, io, shutil, time, zipfile
+from typing import BinaryIO, Iterable, Tuple
 
 from lib.crypt_utils import Crypt
 import lib.ui_logger as logging
@@ -15,7 +16,7 @@ class IndexFileHelper:
     _was_zipped_on_load: bool = False
 
     @classmethod
-    def load_index(cls, file_path: str):
+    def load_index(cls, file_path: str, strip_padding: bool = False):
         """
         Loads an XML index file from the given path.
         It decrypts the file, checks for ZIP compression, decompresses if necessary,
@@ -23,39 +24,51 @@ class IndexFileHelper:
 
         Args:
             file_path (str): The path to the XML index file.
+            strip_padding (bool): Return a view without the padding instead of
+                                  a copy with the padding turned into spaces.
 
         Returns:
-            bytearray: The decrypted and unpadded XML data.
+            bytearray | memoryview: The decrypted and unpadded XML data.
 
         Raises:
             FileNotFoundError: If the file does not exist
             ValueError: If the file content is invalid or malformed
             zipfile.BadZipFile: If it's detected as a zip but is corrupted
         """
+        xml_bytes, cls._was_zipped_on_load = cls.read_index(file_path, strip_padding)
+        return xml_bytes
+
+    @staticmethod
+    def read_index(
+        file_path: str, strip_padding: bool = False
+    ) -> Tuple[bytearray | memoryview, bool]:
+        """
+        Same as `load_index` but without touching the class state, so it is
+        safe to call from a background thread.
+
+        Returns:
+            tuple: The unpadded XML data and whether the file was zipped.
+        """
         if not os.path.exists(file_path):
             raise FileNotFoundError(f"Index file not found: {file_path}")
 
-        raw_data: bytes = b""
         try:
-            with open(file_path, "rb") as f:
-                raw_data = f.read()
+            stream = Crypt.open_decrypted(file_path)
         except IOError as e:
             raise IOError(f"Error reading file {file_path}: {e}")
 
-        # Decrypt the data first
-        decrypted_data = Crypt.decrypt(raw_data)
-
-        # Check for ZIP magic bytes (PK\x03\x04) at the beginning
-        # C# checks len > 2 and data[0] == 0x50 and data[1] == 0x4b.
-        # A full ZIP magic number is 0x50 0x4B 0x03 0x04.
-        if len(decrypted_data) >= 4 and decrypted_data[:4] == b"PK\x03\x04":
-            cls._was_zipped_on_load = True
-            logging.debug(
-                f"File {file_path} detected as zipped, decompressing 'index' entry..."
-            )
-            try:
-                # Use BytesIO to treat the decrypted data as a file in memory
-                with io.BytesIO(decrypted_data) as stream:
+        # Decrypt while reading, the whole ciphertext is never held in memory
+        with stream:
+            # Check for ZIP magic bytes (PK\x03\x04) at the beginning
+            # C# checks len > 2 and data[0] == 0x50 and data[1] == 0x4b.
+            # A full ZIP magic number is 0x50 0x4B 0x03 0x04.
+            zipped = stream.peek(4)[:4] == b"PK\x03\x04"
+            if zipped:
+                logging.debug(
+                    f"File {file_path} detected as zipped, decompressing 'index' entry..."
+                )
+                try:
+                    # ZipFile seeks around the decrypting stream directly
                     with zipfile.ZipFile(stream, "r") as zf:
                         # GetEntry("index") is equivalent to zf.open("index")
                         # You can also use zf.read("index") to get content directly.
@@ -65,19 +78,18 @@ class IndexFileHelper:
                             raise ValueError(
                                 f"Zip archive {file_path} does not contain an 'index' entry."
                             )
-            except zipfile.BadZipFile as e:
-                raise zipfile.BadZipFile(
-                    f"Error decompressing zip file {file_path}: {e}"
-                )
-            except Exception as e:  # Catch other potential errors during zip processing
-                raise ValueError(
-                    f"An unexpected error occurred during zip processing for {file_path}: {e}"
-                )
-        else:
-            cls._was_zipped_on_load = False
-            xml_bytes = decrypted_data
-
-        return Crypt.unpad(xml_bytes)
+                except zipfile.BadZipFile as e:
+                    raise zipfile.BadZipFile(
+                        f"Error decompressing zip file {file_path}: {e}"
+                    )
+                except Exception as e:  # Catch other potential errors during zip processing
+                    raise ValueError(
+                        f"An unexpected error occurred during zip processing for {file_path}: {e}"
+                    )
+            else:
+                xml_bytes = stream.read()
+
+        return Crypt.unpad(xml_bytes, strip_padding), zipped
 
     @classmethod
     def save_index(cls, data_to_encrypt: bytes, file_path: str, zipped=False):
@@ -89,26 +101,61 @@ class IndexFileHelper:
             data_to_encrypt (bytes): The bytes to save.
             file_path (str): The path where the XML file will be saved.
         """
-        if not zipped and cls._was_zipped_on_load:
-            zipped = cls._was_zipped_on_load
+        cls.save_index_chunks([data_to_encrypt], file_path, zipped)
+
+    @staticmethod
+    def _write_padded(chunks: Iterable[bytes], out: BinaryIO):
+        # same null padding as Crypt.pad, without joining the chunks first
+        length = 0
+        for chunk in chunks:
+            out.write(chunk)
+            length += len(chunk)
+        out.write(b"\0" * (-length % 16))
 
-        data_to_encrypt = Crypt.pad(data_to_encrypt)
-        # Conditionally zip the data if the original file was zipped
-        if zipped:
-            with io.BytesIO() as stream_zip:
-                # 'w' mode for writing, ZIP_DEFLATED for compression
-                with zipfile.ZipFile(
-                    stream_zip, "w", zipfile.ZIP_DEFLATED, allowZip64=False
-                ) as zf:
-                    # 'index' is the entry name inside the zip
-                    zf.writestr("index", data_to_encrypt)
-                data_to_encrypt = stream_zip.getvalue()
+    @classmethod
+    def save_index_chunks(
+        cls, chunks: Iterable[bytes], file_path: str, zipped=False
+    ):
+        """
+        Like `save_index`, but streams `chunks` through padding, optional
+        zip compression and encryption straight into the file, so the full
+        XML, padded, zipped and encrypted copies never coexist in memory.
+        The file is written next to `file_path` and swapped in when complete.
 
-        encrypted_data = Crypt.encrypt(data_to_encrypt)
+        Args:
+            chunks (Iterable[bytes]): The XML bytes, in order.
+            file_path (str): The path where the index will be saved.
+            zipped (bool): Zip before encrypting. Also on if the loaded index was zipped.
+        """
+        if not zipped and cls._was_zipped_on_load:
+            zipped = cls._was_zipped_on_load
 
+        tmp_file = file_path + ".tmp"
         try:
-            with open(file_path, "wb") as f:
-                f.write(encrypted_data)
+            with Crypt.open_encrypted(tmp_file) as out:
+                # Conditionally zip the data if the original file was zipped
+                if zipped:
+                    # only the compressed bytes are buffered
+                    with io.BytesIO() as stream_zip:
+                        # 'w' mode for writing, ZIP_DEFLATED for compression
+                        with zipfile.ZipFile(
+                            stream_zip, "w", zipfile.ZIP_DEFLATED, allowZip64=False
+                        ) as zf:
+                            # 'index' is the entry name inside the zip,
+                            # same header fields as zf.writestr("index", ...)
+                            info = zipfile.ZipInfo("index", time.localtime()[:6])
+                            info.compress_type = zipfile.ZIP_DEFLATED
+                            info.external_attr = 0o600 << 16
+                            with zf.open(info, "w") as member:
+                                cls._write_padded(chunks, member)
+                        stream_zip.seek(0)
+                        shutil.copyfileobj(stream_zip, out)
+                else:
+                    cls._write_padded(chunks, out)
+
+            os.replace(tmp_file, file_path)
         except IOError as e:
+            if os.path.exists(tmp_file):
+                os.remove(tmp_file)
             raise IOError(f"Error writing to file {file_path}: {e}")
         logging.info(f"Index saved successfully to: {file_path}")
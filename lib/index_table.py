@@ -0,0 +1,188 @@
+import re
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional
+
+from lxml import etree as et
+
+parser = et.XMLParser(collect_ids=False, remove_comments=True)
+
+# same characters lxml escapes when serializing attribute values
+_ATTR_ESCAPE = re.compile(r'[&<>"\n\r\t]')
+_ATTR_ESCAPES = {
+    "&": "&amp;",
+    "<": "&lt;",
+    ">": "&gt;",
+    '"': "&quot;",
+    "\n": "&#10;",
+    "\r": "&#13;",
+    "\t": "&#9;",
+}
+
+Entry = Dict[str, str]
+
+
+def _quote(value: str) -> str:
+    if not _ATTR_ESCAPE.search(value):
+        return f'"{value}"'
+    return f'"{_ATTR_ESCAPE.sub(lambda m: _ATTR_ESCAPES[m.group(0)], value)}"'
+
+
+def _format_attrib(attrib: Entry) -> str:
+    # one scan over all values instead of one per value for the common case
+    if not _ATTR_ESCAPE.search("".join(attrib.values())):
+        return "".join(f' {k}="{v}"' for k, v in attrib.items())
+    return "".join(f" {k}={_quote(v)}" for k, v in attrib.items())
+
+
+class IndexTable:
+    """
+    In-memory form of Package/index: the root tag/attributes plus one plain
+    attribute dict per <entry>, the only children it accepts. Entries support
+    `get` like lxml elements, so callers read them the same way; writes go
+    through item assignment.
+    """
+
+    ENTRY_TAG = "entry"
+
+    def __init__(
+        self,
+        tag: str = "index",
+        attrib: Optional[Entry] = None,
+        entries: Optional[List[Entry]] = None,
+        zipped: bool = False,
+    ):
+        self.tag = tag
+        self.attrib: Entry = attrib or {}
+        self.entries: List[Entry] = entries or []
+        # whether Package/index was zipped before encryption, kept for saving
+        self.zipped = zipped
+        # entries changed since load/save, by id() since dicts aren't hashable
+        self._dirty: Dict[int, Entry] = {}
+        # lookups by normalized 'original', built on first use
+        self._by_original: Optional[Dict[str, Entry]] = None
+        self._sorted_originals: Optional[List[str]] = None
+        self._sorted_positions: Optional[List[int]] = None
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __iter__(self) -> Iterator[Entry]:
+        return iter(self.entries)
+
+    @classmethod
+    def from_xml(
+        cls, xml_bytes: bytes | bytearray | memoryview, zipped: bool = False
+    ) -> "IndexTable":
+        try:
+            # parse straight from the buffer, no copy
+            root = et.fromstring(xml_bytes, parser)
+        except (TypeError, ValueError):
+            # lxml releases without buffer support need real bytes
+            root = et.fromstring(bytes(xml_bytes), parser)
+        if root is None:
+            raise ValueError("Index is empty: Package/index not found or corrupted.")
+        cls._check_shape(root)
+        entries = [dict(entry.attrib) for entry in root]
+        return cls(root.tag, dict(root.attrib), entries, zipped)
+
+    @classmethod
+    def _check_shape(cls, root):
+        # only what iter_xml writes back: empty <entry> children with attributes,
+        # whitespace between them. Anything else would be lost on save.
+        if (root.text or "").strip():
+            raise ValueError("Unexpected text in the index root.")
+        for child in root:
+            if child.tag != cls.ENTRY_TAG:
+                name = child.tag if isinstance(child.tag, str) else type(child).__name__
+                raise ValueError(f"Unexpected {name} in the index.")
+            if len(child) or (child.text or "").strip() or (child.tail or "").strip():
+                raise ValueError(f"Unexpected content in index entry {child.attrib}.")
+
+    @staticmethod
+    def normalize(original: str) -> str:
+        return original.replace("\\", "/")
+
+    def _build_lookups(self):
+        by_original: Dict[str, Entry] = {}
+        keyed = []
+        for pos, entry in enumerate(self.entries):
+            original = entry.get("original")
+            if original is None:
+                continue
+            key = self.normalize(original)
+            # first entry wins, like a top-down scan would
+            by_original.setdefault(key, entry)
+            keyed.append((key, pos))
+        keyed.sort()
+        self._by_original = by_original
+        self._sorted_originals = [key for key, _ in keyed]
+        self._sorted_positions = [pos for _, pos in keyed]
+
+    def find(self, original: str) -> Optional[Entry]:
+        """Returns the entry whose normalized 'original' equals `original`."""
+        if self._by_original is None:
+            self._build_lookups()
+        return self._by_original.get(original)  # type: ignore
+
+    def find_prefix(self, prefixes: Iterable[str]) -> List[Entry]:
+        """
+        Returns entries whose normalized 'original' starts with any of
+        `prefixes`, in index order. Each prefix is a binary search over the
+        sorted originals, so the cost follows the number of matches.
+        """
+        if self._sorted_originals is None:
+            self._build_lookups()
+        keys: List[str] = self._sorted_originals  # type: ignore
+        positions: List[int] = self._sorted_positions  # type: ignore
+
+        found = set()
+        for prefix in prefixes:
+            i = bisect_left(keys, prefix)
+            while i < len(keys) and keys[i].startswith(prefix):
+                found.add(positions[i])
+                i += 1
+        return [self.entries[pos] for pos in sorted(found)]
+
+    @property
+    def is_dirty(self) -> bool:
+        return bool(self._dirty)
+
+    @property
+    def dirty_entries(self) -> List[Entry]:
+        return list(self._dirty.values())
+
+    def mark_clean(self):
+        self._dirty.clear()
+
+    def update_entry(self, entry: Entry, values: Dict[str, str]) -> bool:
+        """Sets `values` on `entry`; it is marked dirty only if one differs."""
+        changed = {k: v for k, v in values.items() if entry.get(k) != v}
+        if not changed:
+            return False
+        entry.update(changed)
+        self._dirty[id(entry)] = entry
+        return True
+
+    def has_data_pack(self) -> bool:
+        return any(
+            entry.get("pack", "").startswith("../Data/") for entry in self.entries
+        )
+
+    def iter_xml(self, chunk_entries: int = 4096) -> Iterator[bytes]:
+        """Serializes the table as utf-8 XML, yielding it in chunks."""
+        yield (
+            "<?xml version='1.0' encoding='utf-8'?>\n"
+            f"<{self.tag}{_format_attrib(self.attrib)}>"
+        ).encode("utf-8")
+
+        entries = self.entries
+        for i in range(0, len(entries), chunk_entries):
+            yield "".join(
+                f"\n\t<{self.ENTRY_TAG}{_format_attrib(entry)}/>"
+                for entry in entries[i : i + chunk_entries]
+            ).encode("utf-8")
+
+        yield f"\n</{self.tag}>".encode("utf-8")
+
+    def to_xml(self) -> bytes:
+        return b"".join(self.iter_xml())
@@ -0,0 +1,117 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import shutil
+from typing import Dict, NamedTuple, Optional, Set
+
+from lib import re_utils
+
+# bump when the layout below or the LuaUtils scanner (_extract_spans, the
+# helpers it calls and _references) changes; pattern edits count by themselves
+_VERSION = 3
+
+
+def _parser_version() -> bytes:
+    # every pattern of re_utils, so editing one invalidates all entries
+    hash_obj = hashlib.blake2b(str(_VERSION).encode("utf-8"), digest_size=8)
+    for name, value in sorted(vars(re_utils).items()):
+        if isinstance(value, re.Pattern):
+            hash_obj.update(f"\0{name}\0{value.flags}\0{value.pattern}".encode("utf-8"))
+    return hash_obj.digest()
+
+
+_PARSER_VERSION = _parser_version()
+
+
+class Span(NamedTuple):
+    """
+    Where a definition sits in its source. A clean span's slice is the
+    definition text, others still hold comment or blank lines to remove.
+    """
+
+    start: int
+    end: int
+    clean: bool
+
+
+class LuaParsed(NamedTuple):
+    """Definition spans of one Lua source and the identifiers each block references."""
+
+    spans: Dict[str, Span]
+    refs: Dict[str, Set[str]]
+
+
+class LuaDefinitionCache:
+    """
+    Parsed Lua definitions on disk, one JSON file per source content hash,
+    so unchanged scripts skip `_extract_spans` and the reference scan.
+    Entries sit in a folder named after the parser version; `prune` removes
+    the folders of other versions.
+    """
+
+    def __init__(self, cache_dir: str):
+        self.cache_dir = cache_dir
+        self.version_dir = os.path.join(cache_dir, _PARSER_VERSION.hex())
+
+    @staticmethod
+    def prune(cache_dir: str):
+        """Delete what other parser versions left in `cache_dir`."""
+        current = _PARSER_VERSION.hex()
+        try:
+            names = os.listdir(cache_dir)
+        except FileNotFoundError:
+            return
+        for name in names:
+            if name == current:
+                continue
+            path = os.path.join(cache_dir, name)
+            logging.debug(f"Removing stale Lua cache {path}")
+            if os.path.isdir(path):
+                shutil.rmtree(path, ignore_errors=True)
+            else:
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+
+    @staticmethod
+    def key_of(raw_code: str) -> str:
+        hash_obj = hashlib.blake2b(_PARSER_VERSION)
+        hash_obj.update(raw_code.encode("utf-8"))
+        return hash_obj.hexdigest()
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.version_dir, key[:2], key + ".json")
+
+    def load(self, raw_code: str) -> Optional[LuaParsed]:
+        try:
+            with open(self._path(self.key_of(raw_code)), "r", encoding="utf-8") as f:
+                data = json.load(f)
+            spans = {key: Span(*span) for key, *span in data["spans"]}
+            refs = {key: set(names) for key, names in data["refs"].items()}
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            # unreadable, truncated or another layout: parse again
+            logging.warning(f"Lua cache entry unreadable, ignored: {e}")
+            return None
+        return LuaParsed(spans, refs)
+
+    def save(self, raw_code: str, parsed: LuaParsed):
+        file_path = self._path(self.key_of(raw_code))
+        # unique per process, several workers may parse the same content
+        tmp_file = f"{file_path}.{os.getpid()}.tmp"
+        data = {
+            # a list keeps the definition order
+            "spans": [[key, *span] for key, span in parsed.spans.items()],
+            "refs": {key: sorted(names) for key, names in parsed.refs.items()},
+        }
+        try:
+            os.makedirs(os.path.dirname(file_path), exist_ok=True)
+            with open(tmp_file, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_file, file_path)
+        except OSError as e:
+            logging.warning(f"Can't write Lua cache {file_path}: {e}")
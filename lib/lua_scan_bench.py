@@ -0,0 +1,92 @@
+import os
+import sys
+import time
+import tracemalloc
+from typing import Dict
+
+from lib import re_utils
+from lib.lua_utils import LuaUtils
+from lib.utils import Utils
+
+# python -m lib.lua_scan_bench "Game_folder/Data/script"
+
+
+def extract_definitions_old(txt: str) -> Dict[str, str]:
+    # previous pipeline, kept for comparison: three passes over the text
+    blocks = Utils.remove_blank_lines(txt)
+    blocks = re_utils.COMMENT.sub("", blocks)
+    blocks = re_utils.DEF.split(blocks)
+    definitions: Dict[str, str] = {}
+
+    for block in blocks:
+        clean_block = block.strip()
+        if not clean_block:
+            continue
+        func_match = re_utils.FUNC_DEF.match(clean_block)
+        if func_match:
+            definitions[func_match.group(0)] = clean_block
+            continue
+        if_match = re_utils.STARTSWITH_IF.match(clean_block)
+        if if_match:
+            definitions[if_match.group(0)] = clean_block
+            continue
+        if "=" in clean_block:
+            key, _ = clean_block.split("=", 1)
+            definitions[key.rstrip()] = clean_block
+    return definitions
+
+
+def scan_spans(txt: str):
+    # spans only, what a caller keeping offsets pays
+    return list(LuaUtils._scan_definitions(LuaUtils._with_lf(txt)))
+
+
+def measure(func, sources):
+    start = time.perf_counter()
+    for txt in sources:
+        func(txt)
+    elapsed = time.perf_counter() - start
+
+    # peak is measured per file, on a separate run so tracing doesn't skew time
+    peak = 0
+    for txt in sources:
+        tracemalloc.start()
+        func(txt)
+        peak = max(peak, tracemalloc.get_traced_memory()[1])
+        tracemalloc.stop()
+    return elapsed, peak
+
+
+def run(script_dir: str):
+    sources = []
+    for root, _, files in os.walk(script_dir):
+        for filename in files:
+            if filename.endswith(".lua"):
+                with open(os.path.join(root, filename), "r", encoding="utf-8") as f:
+                    sources.append(f.read())
+    total_mb = sum(len(txt) for txt in sources) / (1 << 20)
+    print(f"{len(sources)} files, {total_mb:.1f} MB")
+
+    mismatched = sum(
+        extract_definitions_old(txt) != LuaUtils._extract_definitions(txt)
+        for txt in sources
+    )
+    print(f"files with different definitions: {mismatched}")
+
+    for name, func in (
+        ("regex pipeline", extract_definitions_old),
+        ("scanner + text", LuaUtils._extract_definitions),
+        ("scanner spans ", scan_spans),
+    ):
+        elapsed, peak = measure(func, sources)
+        print(
+            f"{name}  {elapsed:7.3f} s  {total_mb / elapsed:6.1f} MB/s  "
+            f"peak {peak / (1 << 20):6.2f} MB"
+        )
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 2:
+        print("usage: python -m lib.lua_scan_bench <script dir>")
+        sys.exit(1)
+    run(sys.argv[1])
@@ -1,10 +1,28 @@
+import hashlib
+import itertools
 import logging
 import os
 from collections import defaultdict, deque
-from typing import DefaultDict, Dict, List, Optional, Set, Tuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import (
+    Any,
+    DefaultDict,
+    Dict,
+    Iterable,
+    Iterator,
+    List,
+    Mapping,
+    MutableMapping,
+    NamedTuple,
+    Optional,
+    Set,
+    Tuple,
+    Union,
+)
 
 from lib import re_utils
 from lib.difflib_utils import summarize_diff
+from lib.lua_cache import LuaDefinitionCache, LuaParsed, Span
 from lib.utils import Utils
 
 templates = {
@@ -22,35 +40,228 @@ templates = {
 \t\tnew_code=r"""{new}""",
 \t\tcount=1
 \t)
+''',
+    "edit": '''
+\tscript.edit_code(
+\t\tdef_name="{name}",
+\t\tedits=[{edits}
+\t\t],
+\t)
 ''',
 }
 
+# one entry of the "edit" template's list
+edit_templates = {
+    "delete": '''
+\t\t\t{{
+\t\t\t\t"type": "delete",
+\t\t\t\t"old_code": r"""{old}""",
+\t\t\t\t"count": 1,
+\t\t\t\t"line": {line},
+\t\t\t}},''',
+    "replace": '''
+\t\t\t{{
+\t\t\t\t"type": "replace",
+\t\t\t\t"old_code": r"""{old}""",
+\t\t\t\t"new_code": r"""{new}""",
+\t\t\t\t"count": 1,
+\t\t\t\t"line": {line},
+\t\t\t}},''',
+}
+
+
+class Edit(NamedTuple):
+    """block[start:end] becomes text, offsets into the unedited block."""
+
+    start: int
+    end: int
+    text: str
+
+
+class DefinitionMap(MutableMapping[str, str]):
+    """
+    {key: definition text} of one Lua source. Definitions not assigned since
+    parsing are kept as spans into `source` and sliced out when read, only
+    assigned ones hold their own text. Keys whose text no longer reads as
+    parsed are tracked as they are assigned, see `changed_keys`.
+    """
+
+    def __init__(self, source: str = "", spans: Optional[Dict[str, Span]] = None):
+        self.source = source
+        self._spans: Dict[str, Span] = spans or {}
+        self._entries: Dict[str, Union[Span, str]] = dict(self._spans)
+        self._changed: Set[str] = set()
+
+    def __getitem__(self, key: str) -> str:
+        entry = self._entries[key]
+        if isinstance(entry, str):
+            return entry
+        return LuaUtils._span_text(self.source, entry)
+
+    def __setitem__(self, key: str, value: str):
+        span = self._spans.get(key)
+        if span is not None and value == LuaUtils._span_text(self.source, span):
+            # back to the parsed text
+            self._entries[key] = span
+            self._changed.discard(key)
+            return
+        self._entries[key] = value
+        self._changed.add(key)
+
+    def __delitem__(self, key: str):
+        del self._entries[key]
+        if key in self._spans:
+            self._changed.add(key)
+        else:
+            self._changed.discard(key)
+
+    def __contains__(self, key: object) -> bool:
+        return key in self._entries
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._entries)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def clear(self):
+        self._entries.clear()
+        self._changed = set(self._spans)
+
+    def entry(self, key: str) -> Union[Span, str]:
+        """The stored span or text, the same object until `key` is assigned."""
+        return self._entries[key]
+
+    @property
+    def is_changed(self) -> bool:
+        return bool(self._changed)
+
+    @property
+    def changed_keys(self) -> Set[str]:
+        """Keys added, deleted or assigned a text other than the parsed one."""
+        return set(self._changed)
+
 
 class LuaUtils:
-    def __init__(self, file_path: str):
+    # fewer files than this are parsed in-process, a pool would cost more
+    PARALLEL_MIN_FILES = 8
+    # where parsed definitions are kept between runs, None to always parse
+    cache_dir: Optional[str] = None
+    # str.splitlines boundaries besides \n, all one char long like it
+    _OTHER_LINE_ENDS = "\r\x0b\x0c\x1c\x1d\x1e\x85\u2028\u2029"
+    _TO_LF = str.maketrans(dict.fromkeys(_OTHER_LINE_ENDS, "\n"))
+
+    def __init__(
+        self, file_path: str, parsed: Optional[Tuple[str, LuaParsed]] = None
+    ):
+        """
+        parsed: (raw code, parsed definitions) already read from `file_path`,
+            e.g. by `read_many`. The file is read when not given.
+        """
         self.file_path = file_path
         self._raw_code: Optional[str] = None
-        self._base_map: Optional[Dict[str, str]] = None
-        self._original_map: Optional[Dict[str, str]] = None
+        # _fingerprint of _raw_code, made on the first merge that needs it
+        self._raw_fingerprint: Optional[bytes] = None
+        self._base_map: Optional[DefinitionMap] = None
+        # key -> (stored entry, identifiers it references), valid while the
+        # entry is still that very object; _set_definition drops it
+        self._refs_cache: Dict[str, Tuple[Union[Span, str], Set[str]]] = {}
         self._changes: Dict[str, List[Tuple[str, str]]] = {}
         self._diffs: Dict[str, List[Dict[str, str]]] = {}
-        self.read()
+        if parsed is None:
+            self.read()
+        else:
+            self._set_parsed(*parsed)
 
     @property
-    def base_map(self) -> Dict[str, str]:
+    def base_map(self) -> DefinitionMap:
         if not self._base_map:
             raise ValueError("Lua base_map not initialized")
         return self._base_map
 
     @base_map.setter
     def base_map(self, value: Dict[str, str]):
-        self._base_map = value
+        items = dict(value)  # value may be base_map itself
+        if self._base_map is None:
+            self._base_map = DefinitionMap()
+        # keeps the parsed spans, writeto still compares against them
+        self._base_map.clear()
+        self._base_map.update(items)
+        self._refs_cache.clear()
 
     def read(self):
-        with open(self.file_path, "r", encoding="utf-8") as f:
-            self._raw_code = f.read()
-        self._base_map = LuaUtils._extract_definitions(self._raw_code)
-        self._original_map = self._base_map.copy()
+        self._set_parsed(*LuaUtils._parse_file(self.file_path, LuaUtils.cache_dir))
+
+    def _set_parsed(self, raw_code: str, parsed: LuaParsed):
+        self._raw_code = raw_code
+        self._raw_fingerprint = None
+        self._base_map = DefinitionMap(LuaUtils._with_lf(raw_code), parsed.spans)
+        self._refs_cache = {
+            key: (parsed.spans[key], refs)
+            for key, refs in parsed.refs.items()
+            if key in parsed.spans
+        }
+
+    @staticmethod
+    def _parse_file(
+        file_path: str, cache_dir: Optional[str] = None
+    ) -> Tuple[str, LuaParsed]:
+        # a plain staticmethod, so a worker process can run it
+        with open(file_path, "r", encoding="utf-8") as f:
+            raw_code = f.read()
+        txt = LuaUtils._with_lf(raw_code)
+        if cache_dir is None:
+            return raw_code, LuaParsed(LuaUtils._extract_spans(txt), {})
+
+        cache = LuaDefinitionCache(cache_dir)
+        parsed = cache.load(raw_code)
+        if parsed is None:
+            spans = LuaUtils._extract_spans(txt)
+            refs = {
+                key: LuaUtils._references(LuaUtils._span_text(txt, span))
+                for key, span in spans.items()
+            }
+            parsed = LuaParsed(spans, refs)
+            cache.save(raw_code, parsed)
+        return raw_code, parsed
+
+    @classmethod
+    def read_many(
+        cls, file_paths: Iterable[str], max_workers: Optional[int] = None
+    ) -> Dict[str, "LuaUtils"]:
+        """
+        Parses many Lua files across a process pool.
+        Returns {file_path: LuaUtils}; files that fail are logged and left out.
+        Always processes, whatever the [Extraction] executor: parsing is pure
+        Python and holds the GIL, threads would run one file at a time.
+        `max_workers` (the [Extraction] workers) is used as is.
+        """
+        paths = list(dict.fromkeys(file_paths))
+        utils: Dict[str, LuaUtils] = {}
+
+        workers = max_workers or os.cpu_count() or 1
+        if workers < 2 or len(paths) < cls.PARALLEL_MIN_FILES:
+            for file_path in paths:
+                try:
+                    utils[file_path] = cls(file_path)
+                except Exception as e:
+                    logging.error(f"{e} in {file_path}")
+            return utils
+
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = {
+                executor.submit(
+                    LuaUtils._parse_file, file_path, cls.cache_dir
+                ): file_path
+                for file_path in paths
+            }
+            for future in as_completed(futures):
+                file_path = futures[future]
+                try:
+                    utils[file_path] = cls(file_path, future.result())
+                except Exception as e:
+                    logging.error(f"{e} in {file_path}")
+        return utils
 
     @staticmethod
     def _read_file(file_path: str):
@@ -66,15 +277,26 @@ class LuaUtils:
         with open(file_path, "r", encoding="utf-8") as f:
             return rf"{f.read()}"
 
+    @property
+    def changed_keys(self) -> Set[str]:
+        """Definitions that differ from the parsed file, what writeto would change."""
+        if self._base_map is None:
+            return set()
+        return self._base_map.changed_keys
+
     def writeto(self, fileout: str):
-        if not self._base_map or self._base_map == self._original_map:
+        if not self._base_map or not self._base_map.is_changed:
             return False
 
+        changed = ", ".join(sorted(self._base_map.changed_keys))
+        logging.debug(f"changed definitions in {self.file_path}: {changed}")
         sorted_keys = self._resolve_dependency_order(self._base_map)
-        content = "\n".join(self._base_map[key] for key in sorted_keys) + "\n"
 
-        with open(fileout, "wb") as f:
-            f.write(content.encode("utf-8"))
+        # newline="" writes \n as is, like the bytes written before
+        with open(fileout, "w", encoding="utf-8", newline="") as f:
+            for key in sorted_keys:
+                f.write(self._base_map[key])
+                f.write("\n")
         return True
 
     def create_patch(self, fileout: str, relative_path: str):
@@ -90,10 +312,15 @@ class LuaUtils:
                 f'\n\tscript.add_definition("{name}", r"""{code}""")\n'
             )
 
-        # Handle "update" changes with diffs
+        # Handle "update" changes with diffs, several in one definition
+        # go through a single edit_code
         for name, diffs in self._diffs.items():
-            for diff in diffs:
+            if len(diffs) == 1:
+                diff = diffs[0]
                 change_blocks.append(templates[diff["type"]].format(name=name, **diff))
+                continue
+            edits = "".join(edit_templates[diff["type"]].format(**diff) for diff in diffs)
+            change_blocks.append(templates["edit"].format(name=name, edits=edits))
 
         content = "".join(change_blocks)
 
@@ -108,39 +335,182 @@ class LuaUtils:
 
     @staticmethod
     def _extract_definitions(txt: str) -> Dict[str, str]:
-        blocks = Utils.remove_blank_lines(txt)
-        blocks = re_utils.COMMENT.sub("", blocks)
-        blocks = re_utils.DEF.split(blocks)
-        definitions: Dict[str, str] = {}
-
-        for block in blocks:
-            clean_block = block.strip()
-            if not clean_block:
-                continue
+        txt = LuaUtils._with_lf(txt)
+        spans = LuaUtils._extract_spans(txt)
+        return {key: LuaUtils._span_text(txt, span) for key, span in spans.items()}
 
-            func_match = re_utils.FUNC_DEF.match(clean_block)
-            if func_match:
-                definitions[func_match.group(0)] = clean_block
+    @staticmethod
+    def _extract_spans(txt: str) -> Dict[str, Span]:
+        """{key: span} of the definitions in `txt`, which only uses \\n line ends."""
+        spans: Dict[str, Span] = {}
+
+        for key, start, end in LuaUtils._scan_definitions(txt):
+            span = LuaUtils._block_span(txt, start, end)
+            if key is None:
+                clean_block = LuaUtils._span_text(txt, span)
+                logging.warning(f"not recognized block: {clean_block}")
                 continue
+            spans[key] = span
+        # for key, span in spans.items():
+        #     print(f"{key}: {LuaUtils._span_text(txt, span)}")
+        return spans
 
-            if_match = re_utils.STARTSWITH_IF.match(clean_block)
-            if if_match:
-                definitions[if_match.group(0)] = clean_block
-                continue
+    @staticmethod
+    def _with_lf(txt: str) -> str:
+        """`txt` with \\n as its only line end, offsets stay the same."""
+        if any(char in txt for char in LuaUtils._OTHER_LINE_ENDS):
+            return txt.translate(LuaUtils._TO_LF)
+        return txt
 
-            if "=" in clean_block:
-                key, _ = clean_block.split("=", 1)
-                definitions[key.rstrip()] = clean_block
-                continue
+    @staticmethod
+    def _block_span(txt: str, start: int, end: int) -> Span:
+        """
+        Span of the block `txt[start:end]`. Clean and narrowed to the stripped
+        text when no comment or blank line has to be removed before its end.
+        """
+        if txt.startswith("--", start):
+            return Span(start, end, False)
+        dirty = re_utils.NEEDS_CLEANING.search(txt, start, end)
+        if dirty is not None:
+            if not re_utils.COMMENT_TAIL.fullmatch(txt, dirty.start(), end):
+                return Span(start, end, False)
+            end = dirty.start()
+
+        # str.strip without the copy
+        while start < end and txt[start].isspace():
+            start += 1
+        while end > start and txt[end - 1].isspace():
+            end -= 1
+        return Span(start, end, True)
+
+    @staticmethod
+    def _span_text(txt: str, span: Span) -> str:
+        if span.clean:
+            return txt[span.start : span.end]
+        block = Utils.remove_blank_lines(txt[span.start : span.end])
+        return re_utils.COMMENT.sub("", block).strip()
+
+    @staticmethod
+    def _normalize_block(txt: str, start: int = 0, end: Optional[int] = None) -> str:
+        """The definition text of the block `txt[start:end]`."""
+        if end is None:
+            end = len(txt)
+        return LuaUtils._span_text(txt, LuaUtils._block_span(txt, start, end))
+
+    @staticmethod
+    def _block_key(clean_block: str) -> Optional[str]:
+        func_match = re_utils.FUNC_DEF.match(clean_block)
+        if func_match:
+            return func_match.group(0)
+
+        if_match = re_utils.STARTSWITH_IF.match(clean_block)
+        if if_match:
+            return if_match.group(0)
 
-            logging.warning(f"not recognized block: {clean_block}")
-        # for key, value in definitions.items():
-        #     print(f"{key}: {value}")
-        return definitions
+        if "=" in clean_block:
+            key, _ = clean_block.split("=", 1)
+            return key.rstrip()
+        return None
+
+    @staticmethod
+    def _head_key(head: str) -> Tuple[bool, Optional[str]]:
+        """
+        Key of a block from its first line alone, as `_block_key` would find
+        it in the whole block. (False, None) when the following lines could
+        still change it, e.g. `local` with `function f` on the next line.
+        """
+        func_match = re_utils.FUNC_DEF.match(head)
+        if func_match:
+            return True, func_match.group(0)
+        if re_utils.FUNC_DEF_PARTIAL.fullmatch(head.rstrip()):
+            return False, None
+
+        if_match = re_utils.STARTSWITH_IF.match(head)
+        if if_match:
+            # `.+` keeps trailing spaces only if more lines follow
+            if head[-1].isspace() or if_match.group(0).rstrip() == "if":
+                return False, None
+            return True, if_match.group(0)
+        if head.rstrip() == "if":
+            return False, None
+
+        if "=" in head:
+            key, _ = head.split("=", 1)
+            return True, key.rstrip()
+        return False, None
+
+    @staticmethod
+    def _scan_definitions(txt: str) -> Iterator[Tuple[Optional[str], int, int]]:
+        """
+        Splits Lua source into top-level definition blocks in one pass, with
+        the same result as removing blank lines, stripping `COMMENT` and
+        splitting on `DEF`. Only definition and block comment lines starting at
+        column 0 are looked at, `SCAN_LINE` finds those. `txt` must only
+        use \\n line ends, see `_with_lf`.
+        Yields (key, start, end) offsets into `txt`, the blocks aren't copied;
+        key is None for a block not recognized.
+
+        Only differs from that pipeline when comment lines sit inside a
+        definition header split over lines, e.g. `local` / `-- x` / `function f`.
+        """
+        starts = [0]
+        comment_end = -1  # a block comment runs until this offset
+
+        line_starts = (m.end() for m in re_utils.SCAN_LINE.finditer(txt))
+        if re_utils.SCAN_START.match(txt):
+            line_starts = itertools.chain((0,), line_starts)
+
+        for start in line_starts:
+            if start < comment_end:
+                continue  # commented out
+            opening = re_utils.BLOCK_COMMENT_OPEN.match(txt, start)
+            if opening is not None:
+                close_str = f"]{opening.group(1)}]"
+                close = txt.find(close_str, opening.end())
+                if close == -1:
+                    continue  # never closed, a line comment
+                comment_end = close + len(close_str)
+                # what follows the comment on its last line reads as a new line
+                if not re_utils.DEF_AT.match(txt, comment_end):
+                    continue
+                start = comment_end
+            starts.append(start)
+
+        ends = starts[1:] + [len(txt)]
+        for i, (start, end) in enumerate(zip(starts, ends)):
+            if i > 0:
+                line_end = txt.find("\n", start, end)
+                head = txt[start : end if line_end == -1 else line_end]
+                decided, key = LuaUtils._head_key(head)
+                if decided:
+                    yield key, start, end
+                    continue
+
+            # the text before the first definition, or an undecided head
+            clean_block = LuaUtils._normalize_block(txt, start, end)
+            if clean_block:
+                yield LuaUtils._block_key(clean_block), start, end
+
+    @staticmethod
+    def _references(value: str) -> Set[str]:
+        return {m.group(0) for m in re_utils.IDENTIFIERS.finditer(value)}
+
+    def _references_of(self, key: str) -> Set[str]:
+        entry = self.base_map.entry(key)
+        cached = self._refs_cache.get(key)
+        if cached is not None and cached[0] is entry:
+            return cached[1]
+        refs = LuaUtils._references(self.base_map[key])
+        self._refs_cache[key] = (entry, refs)
+        return refs
+
+    def _set_definition(self, key: str, code: str):
+        self.base_map[key] = code
+        self._refs_cache.pop(key, None)
 
     @staticmethod
     def _build_identifier_map(
-        items: Dict[str, str],
+        items: Mapping[str, str],
     ) -> Tuple[Dict[str, str], Dict[str, Set[str]], Dict[str, int]]:
         """Builds maps for identifiers and initializes in-degree counts."""
         identifier_map: Dict[str, str] = {}
@@ -173,7 +543,7 @@ class LuaUtils:
 
     @staticmethod
     def _find_key_dependencies(
-        items: Dict[str, str],
+        items: Mapping[str, str],
         identifier_map: Dict[str, str],
         in_degree: Dict[str, int],
         reverse_graph: DefaultDict[str, Set],
@@ -208,7 +578,7 @@ class LuaUtils:
                     reverse_graph[obj_name].add(key)
                     seen.add(obj_name)
 
-    def _resolve_dependency_order(self, items: Dict[str, str]) -> List[str]:
+    def _resolve_dependency_order(self, items: DefinitionMap) -> List[str]:
         """
         Given a dict of items {key: value}, where values may reference other keys,
         returns a list of keys sorted so that dependencies appear before dependents.
@@ -223,10 +593,10 @@ class LuaUtils:
         # Build the dependency graph
         LuaUtils._find_key_dependencies(items, identifier_map, in_degree, reverse_graph)
 
-        # find value dependencies
-        for key, value in items.items():
+        # find value dependencies, only edited blocks are scanned again
+        for key in items:
             vars_from_key = split_keys.get(key, set())
-            referenced_vars = {m.group(0) for m in re_utils.IDENTIFIERS.finditer(value)}
+            referenced_vars = self._references_of(key)
             for ref in referenced_vars:
                 # if ref in all_keys and ref != key:
                 if ref in identifier_map and ref not in vars_from_key:
@@ -265,11 +635,30 @@ class LuaUtils:
                 changes["update"].append((key, value))
         return changes
 
+    @staticmethod
+    def _fingerprint(txt: str) -> bytes:
+        """
+        Hash of the code in `txt` without comments, blank lines and trailing
+        spaces, equal for sources that only differ in those.
+        """
+        code = re_utils.COMMENT.sub("", LuaUtils._with_lf(txt))
+        lines = (line.rstrip() for line in code.split("\n"))
+        code = "\n".join(line for line in lines if line)
+        return hashlib.blake2b(code.encode("utf-8"), digest_size=16).digest()
+
     def merge_with(self, update_file: str, is_create_patch: Optional[bool] = None):
         update_raw_code = LuaUtils._read_file(update_file)
         if self._raw_code == update_raw_code:
             return
 
+        # same code with other comments or spacing, nothing to parse or diff
+        if self._raw_code is not None:
+            if self._raw_fingerprint is None:
+                self._raw_fingerprint = LuaUtils._fingerprint(self._raw_code)
+            if LuaUtils._fingerprint(update_raw_code) == self._raw_fingerprint:
+                logging.debug(f"{update_file} only differs in comments or spacing")
+                return
+
         update_map = LuaUtils._extract_definitions(update_raw_code)
         self._changes = self._find_changes(update_map)
 
@@ -289,7 +678,8 @@ class LuaUtils:
         for key, value in self._changes["update"]:
             merged_map[key] = f"-- UPDATE\n{value}"
 
-        self.base_map.update(merged_map)
+        for key, value in merged_map.items():
+            self._set_definition(key, value)
 
     def _get_code_from_args(
         self,
@@ -317,14 +707,14 @@ class LuaUtils:
             logging.warning(f"Def '{def_name}' already exists. overwrite.")
             # raise ValueError(f"Func/Var '{def_name}' already exists.")
         code_to_add = self._get_code_from_args(code, from_file)
-        self.base_map[def_name] = code_to_add
+        self._set_definition(def_name, code_to_add)
 
     def replace_definition(self, def_name, code=None, from_file=None):
         if not self.base_map.get(def_name):
             logging.warning(f"Def '{def_name}' not found. add new.")
             # raise ValueError(f"Func/Var '{def_name}' not found.")
         code_to_replace = self._get_code_from_args(code, from_file)
-        self.base_map[def_name] = code_to_replace
+        self._set_definition(def_name, code_to_replace)
 
     def replace_code(
         self,
@@ -344,8 +734,8 @@ class LuaUtils:
         code_to_replace = self._get_code_from_args(
             new_code, from_file, True, "new_code"
         )
-        self.base_map[def_name] = def_block_code.replace(
-            old_code, code_to_replace, count
+        self._set_definition(
+            def_name, def_block_code.replace(old_code, code_to_replace, count)
         )
 
     def delete_code(self, def_name: str, old_code: str, count=-1):
@@ -362,47 +752,14 @@ class LuaUtils:
     ):
         if count == 0:
             return
-        if not target:
-            raise ValueError("target must be provided.")
-        if position not in ("before", "after"):
-            raise ValueError("Position must be 'before' or 'after'.")
-
         block_code = self.base_map.get(def_name)
-        if not block_code:
-            raise ValueError(f"'{def_name}' not found.")
-        code_to_insert = self._get_code_from_args(code, from_file)
-        target = Utils.remove_blank_lines(target)
-
-        parts = []
-        limit = offset = pos = 0
-
-        while (pos := block_code.find(target, pos)) != -1:
-            line_start = block_code.rfind("\n", 0, pos) + 1
-            line_end = block_code.find("\n", pos + len(target))
-            if line_end == -1:
-                line_end = len(block_code)
-
-            # # whole lines matches
-            # if block_code[line_start:line_end] == target:
-
-            if position == "before":
-                parts.extend([block_code[offset:line_start], code_to_insert + "\n"])
-                offset = line_start
-            elif position == "after":
-                parts.extend([block_code[offset:line_end], "\n" + code_to_insert])
-                offset = line_end
-
-            limit += 1
-            if count != -1 and limit >= count:
-                break
-
-            pos = line_end + 1  # move to next line
-
-        if limit == 0:
-            raise ValueError(f"{target} not found in '{def_name}'.")
-
-        parts.append(block_code[offset:])
-        self.base_map[def_name] = "".join(parts)
+        edits = self._insert_edits(
+            def_name, block_code, target, code, from_file, position, count
+        )
+        assert block_code is not None
+        self._set_definition(
+            def_name, LuaUtils._apply_edits(def_name, block_code, edits)
+        )
 
         # for m in re.finditer(rf"(?m)^{re.escape(target)}$", block_code):
         #     if count != -1 and limit >= count:
@@ -453,6 +810,158 @@ class LuaUtils:
         #         parts.append(insert_str)
         #         last_idx = end
 
+    def edit_code(self, def_name: str, edits: List[Dict[str, Any]]):
+        """
+        Several edits of one definition, rebuilt once. Each edit is a dict
+        with "type" ("replace", "delete" or "insert") and the keyword
+        arguments of replace_code, delete_code or insert_code.
+        All targets are looked up in the definition as it was before the
+        call, so edits can't build on each other's result; edits changing
+        the same text raise ValueError and leave the definition as it was.
+        A replace or delete edit may give "line", the 0-based line where
+        old_code is expected to start: the matches nearest to it are used
+        instead of the first ones, as create_patch does with the diff's
+        line numbers.
+        """
+        block_code = self.base_map.get(def_name)
+        if not block_code:
+            raise ValueError(f"'{def_name}' not found")
+
+        found: List[Edit] = []
+        for edit in edits:
+            args = dict(edit)
+            edit_type = args.pop("type", None)
+            if edit_type == "replace":
+                found.extend(self._replace_edits(def_name, block_code, **args))
+            elif edit_type == "delete":
+                found.extend(
+                    self._replace_edits(def_name, block_code, new_code="", **args)
+                )
+            elif edit_type == "insert":
+                found.extend(self._insert_edits(def_name, block_code, **args))
+            else:
+                raise ValueError(f"Unknown edit type: {edit_type}")
+
+        self._set_definition(
+            def_name, LuaUtils._apply_edits(def_name, block_code, found)
+        )
+
+    def _replace_edits(
+        self,
+        def_name: str,
+        block_code: str,
+        old_code: str,
+        new_code: Optional[str] = None,
+        from_file: Optional[str] = None,
+        count=-1,
+        line: Optional[int] = None,
+    ) -> List[Edit]:
+        """
+        Where replace_code would change `block_code`. With `line`, the
+        `count` matches starting nearest to that line are taken.
+        """
+        old_code = Utils.remove_blank_lines(old_code)
+        if not old_code:
+            raise ValueError("old_code cannot be empty.")
+        if old_code not in block_code:
+            raise ValueError(rf"'{old_code}' not found in '{def_name}'")
+        code_to_replace = self._get_code_from_args(
+            new_code, from_file, True, "new_code"
+        )
+
+        # context lines kept by both sides aren't part of the edit, so the
+        # hunks of a generated patch don't overlap
+        prefix = len(os.path.commonprefix([old_code, code_to_replace]))
+        suffix = len(
+            os.path.commonprefix(
+                [old_code[prefix:][::-1], code_to_replace[prefix:][::-1]]
+            )
+        )
+        text = code_to_replace[prefix : len(code_to_replace) - suffix]
+
+        # (line, offset) of the matches, as str.replace finds them
+        matches: List[Tuple[int, int]] = []
+        line_no = 0
+        pos = block_code.find(old_code)
+        while pos != -1 and (line is not None or count < 0 or len(matches) < count):
+            line_no += block_code.count("\n", matches[-1][1] if matches else 0, pos)
+            matches.append((line_no, pos))
+            pos = block_code.find(old_code, pos + len(old_code))
+        if line is not None:
+            # repeated code: the match where the diff saw it, not the first
+            matches.sort(key=lambda match: abs(match[0] - line))
+            if count >= 0:
+                matches = sorted(matches[:count], key=lambda match: match[1])
+        return [
+            Edit(pos + prefix, pos + len(old_code) - suffix, text)
+            for _, pos in matches
+        ]
+
+    def _insert_edits(
+        self,
+        def_name: str,
+        block_code: Optional[str],
+        target: str,
+        code: Optional[str] = None,
+        from_file: Optional[str] = None,
+        position: str = "after",
+        count: int = -1,
+    ) -> List[Edit]:
+        """Where insert_code would change `block_code`."""
+        if count == 0:
+            return []
+        if not target:
+            raise ValueError("target must be provided.")
+        if position not in ("before", "after"):
+            raise ValueError("Position must be 'before' or 'after'.")
+
+        if not block_code:
+            raise ValueError(f"'{def_name}' not found.")
+        code_to_insert = self._get_code_from_args(code, from_file)
+        target = Utils.remove_blank_lines(target)
+
+        found: List[Edit] = []
+        pos = 0
+
+        while (pos := block_code.find(target, pos)) != -1:
+            line_start = block_code.rfind("\n", 0, pos) + 1
+            line_end = block_code.find("\n", pos + len(target))
+            if line_end == -1:
+                line_end = len(block_code)
+
+            # # whole lines matches
+            # if block_code[line_start:line_end] == target:
+
+            if position == "before":
+                found.append(Edit(line_start, line_start, code_to_insert + "\n"))
+            elif position == "after":
+                found.append(Edit(line_end, line_end, "\n" + code_to_insert))
+
+            if count != -1 and len(found) >= count:
+                break
+
+            pos = line_end + 1  # move to next line
+
+        if not found:
+            raise ValueError(f"{target} not found in '{def_name}'.")
+        return found
+
+    @staticmethod
+    def _apply_edits(def_name: str, block_code: str, edits: List[Edit]) -> str:
+        # sort is stable, inserts at one place keep their order
+        edits = sorted(edits, key=lambda edit: (edit.start, edit.end))
+        parts = []
+        offset = 0
+        for start, end, text in edits:
+            if start < offset:
+                raise ValueError(
+                    f"Edits overlap in '{def_name}': {block_code[start:end]!r}"
+                )
+            parts.extend([block_code[offset:start], text])
+            offset = end
+        parts.append(block_code[offset:])
+        return "".join(parts)
+
 
 # def main():
 #     base_script = LuaUtils("./base.lua")
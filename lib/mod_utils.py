@@ -1,4 +1,5 @@
 # import importlib
+import json
 import os
 import runpy
 import shutil
@@ -12,9 +13,10 @@ import lib.ui_logger as logging
 from lib import config_utils
 from lib.asset_manager import AssetManager
 from lib.dic_utils import DicUtils
+from lib.lua_cache import LuaDefinitionCache
 from lib.lua_utils import LuaUtils
 from lib.utils import Utils
-from lib.xml_utils import XmlUtils
+from lib.xml_utils import STREAM_MERGE_EXTS, STREAM_MERGE_SIZE, XML_PATCH_SUFFIX, XmlUtils
 
 Element = et._Element
 ElementTree = et._ElementTree
@@ -35,6 +37,8 @@ class ModUtils:
         self.settings_file: str = os.path.join(self.am.mods_path, "ModSettings.xml")
         self.settings_tree: Optional[ElementTree] = None
         self.settings_root: Optional[Element] = None
+        # "py" or "json", read from the config when creating patches
+        self.xml_patch_format = config_utils.XML_PATCH_FORMAT
 
         self._handler_getters = {
             XmlUtils: self.xml,
@@ -42,6 +46,8 @@ class ModUtils:
             DicUtils: self.dic,
         }
         self.lua = self.script
+        LuaUtils.cache_dir = os.path.join(self.am.cache_path, "lua")
+        LuaDefinitionCache.prune(LuaUtils.cache_dir)
 
     def xml(self, rel_path: str, file_path=None):
         norm_rel_path = os.path.normpath(rel_path)
@@ -95,6 +101,27 @@ class ModUtils:
             rel_path, file_path, self.scripts, LuaUtils, ".lua", self.am.data_path
         )
 
+    def preload_scripts(self, rel_paths):
+        """
+        Parses the given Data/ scripts up front across processes, so the
+        merges that follow find them in the cache.
+        """
+        file_paths: dict[str, str] = {}
+        for rel_path in rel_paths:
+            norm_rel_path = os.path.normpath(rel_path)
+            if not os.path.splitext(norm_rel_path)[1]:
+                norm_rel_path += ".lua"
+            file_path = os.path.join(self.am.data_path, norm_rel_path)
+            if norm_rel_path not in self.scripts and os.path.exists(file_path):
+                file_paths[file_path] = norm_rel_path
+
+        if not file_paths:
+            return
+        logging.debug(f"Parsing {len(file_paths)} scripts...")
+        scripts = LuaUtils.read_many(file_paths, self.am.max_workers)
+        for file_path, script in scripts.items():
+            self.scripts[file_paths[file_path]] = script
+
     def dic(self, rel_path: str, file_path=None):
         return self._get_util(
             rel_path, file_path, self.dics, DicUtils, ".dic", self.am.root
@@ -185,6 +212,10 @@ class ModUtils:
                             main_py_found = True
                             break
 
+                    if filename.endswith(XML_PATCH_SUFFIX):
+                        # extract the file it patches
+                        rel_path = rel_path[: -len(XML_PATCH_SUFFIX)]
+
                     if extension == ".dic" or extension == ".dkm" or quick_extract:
                         continue
 
@@ -202,9 +233,14 @@ class ModUtils:
     def _write_all_files(self):
         from itertools import chain
 
+        # unchanged scripts are known without touching their definitions
+        scripts = [s for s in self.scripts.values() if s.changed_keys]
+        if len(scripts) < len(self.scripts):
+            logging.debug(f"{len(self.scripts) - len(scripts)} scripts without changes")
+
         all_files = chain(
             self.xmls.values(),
-            self.scripts.values(),
+            scripts,
             self.dics.values()
         )
 
@@ -263,6 +299,15 @@ class ModUtils:
             except Exception as e:
                 logging.exception(f"Error patching {mod_file}: {e}")
 
+    def _patch_xml(self, mod_file: str):
+        logging.info(f"Applying patch: {mod_file}")
+        try:
+            with open(mod_file, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            self.xml(data["file"]).apply_patch(data["changes"])
+        except Exception as e:
+            logging.exception(f"Error patching {mod_file}: {e}")
+
     def _override(self, base_file: str, mod_file: str):
         # dir must exist before copy
         os.makedirs(os.path.dirname(base_file), exist_ok=True)
@@ -288,6 +333,17 @@ class ModUtils:
     #     with open(py_file, "w", encoding="utf-8") as f:
     #         f.write(content)
 
+    def _should_stream(self, FileHandlerCls, base_file: str, rel_path: str, is_create_patch) -> bool:
+        # big xml/stage files nothing holds in memory are merged straight on disk,
+        # a handle loaded later (by a patch) reads the merged file
+        return (
+            FileHandlerCls is XmlUtils
+            and not is_create_patch
+            and os.path.splitext(base_file)[1] in STREAM_MERGE_EXTS
+            and os.path.normpath(rel_path) not in self.xmls
+            and os.path.getsize(base_file) >= STREAM_MERGE_SIZE
+        )
+
     def _merge(
         self,
         FileHandlerCls: type[XmlUtils | LuaUtils | DicUtils],
@@ -297,6 +353,11 @@ class ModUtils:
         is_create_patch: Optional[bool] = None,
     ):
         try:
+            if self._should_stream(FileHandlerCls, base_file, rel_path, is_create_patch):
+                if XmlUtils.merge_stream(base_file, mod_file, base_file):
+                    logging.info(f"Patched {base_file} with {mod_file}")
+                return
+
             handler_getter = self._handler_getters[FileHandlerCls]
             file_handle = handler_getter(rel_path, base_file)
 
@@ -306,12 +367,15 @@ class ModUtils:
             if isinstance(file_handle, DicUtils):
                 rs = file_handle.create_patch(mod_file)
             else:
-                py_file = os.path.splitext(mod_file)[0] + ".py"
-                rs = file_handle.create_patch(py_file, rel_path)
+                if isinstance(file_handle, XmlUtils) and self.xml_patch_format == "json":
+                    patch_file = mod_file + XML_PATCH_SUFFIX
+                else:
+                    patch_file = os.path.splitext(mod_file)[0] + ".py"
+                rs = file_handle.create_patch(patch_file, rel_path)
                 if rs != 2:
                     os.remove(mod_file)
                 if rs == 3:
-                    logging.debug(f"{py_file} not change")
+                    logging.debug(f"{patch_file} not change")
                     return
 
             log_map = {
@@ -352,6 +416,11 @@ class ModUtils:
                         self._patch(mod_file)
                     continue
 
+                if mod_file.endswith(XML_PATCH_SUFFIX):
+                    if not is_create_patch:
+                        self._patch_xml(mod_file)
+                    continue
+
                 base_file = (
                     os.path.join(self.am.root, rel_path)
                     if extension in (".dic", ".dkm")
@@ -400,6 +469,14 @@ class ModUtils:
                 self.am.extract_entries(extract_paths, "exact")
 
         self._clear_cache()
+        # every base script the mods merge into, parsed across processes
+        self.preload_scripts(
+            rel_path
+            for mod_data in mod_file_map.values()
+            if not mod_data.has_main_py
+            for rel_path in mod_data.relative_paths
+            if os.path.splitext(rel_path)[1] == ".lua"
+        )
         self._process_mods(mod_file_map, is_create_patch)
 
     def install(self, mod_names: list[str]):
@@ -409,5 +486,6 @@ class ModUtils:
 
     def create_patch(self, mod_names: list[str]):
         logging.info("Preparing Create Patch Mods")
+        self.xml_patch_format = config_utils.load_xml_patch_format()
         self._run_mod_processing(mod_names, True)
         logging.info("Create Patch Mods Done")
@@ -25,6 +25,26 @@ DEF = re.compile(r"""(?mx)(?=(?:
     |^(?:local\s+)?\w[ \t\w,.\[\]"']+\s*=
 ))""")
 
+# DEF for the line scanner: anchored by match(txt, pos) instead of ^,
+# pos may follow a block comment closed mid-line
+_DEF_HEAD = r"""(?:local\s+)?function\s+[.\w:]+
+    |(?:local\s+)?[.\w]+\s*=\s*function\b
+    |(?:local\s+)?\w[ \t\w,.\[\]"']+\s*="""
+DEF_AT = re.compile(rf"(?x)(?=(?:{_DEF_HEAD}))")
+# COMMENT branches, for the line scanner
+BLOCK_COMMENT_OPEN = re.compile(r"--\[(=*)\[")
+# the only lines the scanner looks at: a definition or a block comment
+# at column 0, the match ends where that line starts
+SCAN_START = re.compile(rf"(?x)(?=--\[=*\[|{_DEF_HEAD})")
+SCAN_LINE = re.compile(rf"(?x)\n(?=--\[=*\[|{_DEF_HEAD})")
+# blank or comment lines, a block without them is clean once stripped
+NEEDS_CLEANING = re.compile(r"\n(?:[^\S\n]*\n|--)")
+# only blank and line comment lines up to the end, the usual tail of a
+# block followed by the doc comments of the next definition
+COMMENT_TAIL = re.compile(r"(?:\n(?:--(?!\[=*\[)[^\n]*|[^\S\n]*))*")
+# a header FUNC_DEF could still complete on the next line
+FUNC_DEF_PARTIAL = re.compile(r"(?:local\s+)?function|local")
+
 # for extract key value
 FUNC_DEF = re.compile(r"^(?:local\s+)?function\s+[.\w:]+")
 STARTSWITH_IF = re.compile(r"^if\s+.+")
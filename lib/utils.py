@@ -138,29 +138,52 @@ class Utils:
                 hash_obj.update(chunk)
         return hash_obj.digest()
 
+    # 1 MiB reads: few syscalls, still small enough to stop early on a mismatch
+    COMPARE_CHUNK_SIZE = 1 << 20
+
     @staticmethod
-    def compare_file_with_bytes(file_path: str, source: bytes, chunk_size=8192):
-        with open(file_path, "rb") as f:
-            while chunk := f.read(chunk_size):
-                source_chunk = source[:len(chunk)]  # Slice the source bytes to match the chunk size
-                if chunk != source_chunk:
+    def compare_file_with_bytes(
+        file_path: str, source: Union[bytes, bytearray, memoryview], chunk_size=None
+    ):
+        if chunk_size is None:
+            chunk_size = Utils.COMPARE_CHUNK_SIZE
+        if isinstance(source, memoryview):
+            source = source.cast("B")  # compare bytes, whatever its format
+        if os.path.getsize(file_path) != len(source):
+            return False  # Different size = different
+
+        buffer = bytearray(chunk_size)
+        view = memoryview(buffer)
+        offset = 0
+        with open(file_path, "rb", buffering=0) as f:
+            # read into one reused buffer and memcmp it with source in place,
+            # neither side is copied: slicing bytes would copy, slicing a view
+            # (e.g. of a mapped pack) doesn't
+            while n := f.readinto(buffer):
+                if isinstance(source, memoryview):
+                    same = buffer.startswith(source[offset : offset + n])
+                else:
+                    same = source.startswith(view[:n], offset)
+                if not same:
                     return False  # Files differ at this chunk
-                source = source[len(chunk):]  # Remove the matched chunk from source
-            return len(source) == 0  # If all chunks matched and there are no leftover source bytes
+                offset += n
+        return offset == len(source)  # File may have changed while reading
 
     @staticmethod
-    def should_write(source: Union[str, bytes], dst_path: str, encoding="utf-8"):
+    def should_write(
+        source: Union[str, bytes, bytearray, memoryview], dst_path: str, encoding="utf-8"
+    ):
         """
         Returns True if `dst_path` does not exist or its content differs from `source`.
 
         - If `source` is str, it will be encoded using `encoding` before comparison.
-        - If `source` is bytes, it will be used directly.
+        - If `source` is bytes-like, it will be used directly.
         """
         if not os.path.exists(dst_path):
             return True
         if isinstance(source, str):
             source_bytes = source.encode(encoding)
-        elif isinstance(source, bytes):
+        elif isinstance(source, (bytes, bytearray, memoryview)):
             source_bytes = source
         else:
             raise TypeError(f"Unsupported source type: {type(source)}")
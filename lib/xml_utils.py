@@ -1,9 +1,14 @@
+import hashlib
+import json
 import os
-from typing import Optional, List, Tuple
+import re
+from functools import lru_cache
+from typing import Iterable, Optional, List, Tuple
 from xml.sax.saxutils import quoteattr
 
 from lxml import etree as et
 
+import lib.ui_logger as logging
 from lib.utils import Utils
 
 Element = et._Element
@@ -14,15 +19,70 @@ STAGE_KEYS = {"ActionKey", "Key", "ObjectKey", "Name"}
 STAGE_KEYS2 = {"Group"}
 parser = et.XMLParser(collect_ids=False, remove_comments=True)
 
+# bigger files are merged by XmlUtils.merge_stream when nothing else holds them
+STREAM_MERGE_SIZE = 16 << 20
+STREAM_MERGE_EXTS = {".stage", ".xml"}
+# what ElementTree.write(encoding="utf-8", xml_declaration=True) puts first
+XML_DECLARATION = b"<?xml version='1.0' encoding='UTF-8'?>\n"
+# declarative patches create_patch writes instead of .py, next to the mod file
+XML_PATCH_SUFFIX = ".patch.json"
+
+# one step of the paths _build_xpath makes: tag[@name="value"]...
+_PATH_STEP = re.compile(
+    r"""([\w.:-]+)((?:\[@[\w.:-]+=(?:"[^"]*"|'[^']*')\])*)(?:/|$)"""
+)
+_PATH_PREDICATE = re.compile(r"""\[@([\w.:-]+)=(?:"([^"]*)"|'([^']*)')\]""")
+
+# subtrees the mod doesn't touch are written whole, up to this many elements
+STREAM_BUFFER_ELEMENTS = 4096
+
+
+class _StreamConflict(Exception):
+    """The streaming merge can't give what the tree merge would, use the tree."""
+
+
+class _StreamFrame:
+    """An open base element in merge_stream and the mod element it matched."""
+
+    __slots__ = ("elem", "depth", "mod_children", "mod_index", "matched", "opened", "pending")
+
+    def __init__(self, elem: Element, depth: int, mod: Optional[Element], ext: str):
+        self.elem = elem
+        self.depth = depth
+        # (identifier, child) in mod order, and identifier -> children
+        self.mod_children: list[tuple[tuple, Element]] = []
+        self.mod_index: Optional[dict[tuple, list[Element]]] = None
+        self.matched: set[tuple] = set()
+        # start tag context once a child is written
+        self.opened = None
+        # last child, waiting for its tail; True if its tags are written
+        self.pending: Optional[tuple[Element, bool]] = None
+
+        if mod is not None and len(mod):
+            self.mod_index = {}
+            for child in mod:
+                if isinstance(child, Comment) or XmlUtils._is_ignored(child, ext):
+                    continue
+                ele_id = XmlUtils._get_element_identifier(child, ext)
+                self.mod_children.append((ele_id, child))
+                self.mod_index.setdefault(ele_id, []).append(child)
+
 
 class XmlUtils:
     def __init__(self, file_path: str):
         self.file_path = file_path
         self._tree: Optional[ElementTree] = None
         self._root: Optional[Element] = None
-        self._base_str: Optional[bytes] = None
+        # set when a merge edits the tree; trees handed out to patches are
+        # hashed first instead, writeto compares against that
+        self._modified = False
+        self._base_hash: Optional[bytes] = None
         self._changes: list[dict] = []
         self._change_index: dict = {}
+        # per-parent {identifier: child}, built on first visit and kept
+        # across merge_with calls; only valid for one extension
+        self._children_indexes: dict[Element, dict[tuple, Element]] = {}
+        self._index_ext: Optional[str] = None
         self.is_create_patch: Optional[bool] = None
         self.et = self.ET = et
         self.read()
@@ -31,33 +91,56 @@ class XmlUtils:
     def tree(self) -> ElementTree:
         if self._tree is None:
             raise ValueError("XML tree not initialized or empty")
+        self._hand_out()
         return self._tree
 
     @tree.setter
     def tree(self, value: ElementTree):
         self._tree = value
+        self._modified = True
 
     @property
     def root(self) -> Element:
         if self._root is None:
             raise ValueError("XML root not initialized or empty")
+        self._hand_out()
         return self._root
 
     @root.setter
     def root(self, value: Element):
         self._root = value
+        self._modified = True
+
+    def _hand_out(self):
+        # whoever takes the tree may edit it: indexes can't be trusted anymore,
+        # and writeto needs the tree as it was to tell if it changed
+        self._children_indexes.clear()
+        if not self._modified and self._base_hash is None:
+            self._base_hash = self._tree_hash()
+
+    def _tree_hash(self) -> bytes:
+        return hashlib.blake2b(et.tostring(self._root, encoding="utf-8"), digest_size=16).digest()
 
     def read(self):
         self._tree = et.parse(self.file_path, parser=parser)
         self._root = self._tree.getroot()
-        self._base_str = et.tostring(self._root, encoding="utf-8")
+        self._children_indexes.clear()
+        self._modified = False
+        self._base_hash = None
+
+    @property
+    def is_modified(self) -> bool:
+        if self._modified:
+            return True
+        # never handed out and not edited by merges: nothing to serialize
+        return self._base_hash is not None and self._base_hash != self._tree_hash()
 
     def writeto(self, fileout: str):
-        if self._base_str == et.tostring(self.root, encoding="utf-8"):
+        if not self.is_modified:
             return False
 
-        et.indent(self.root, space="\t")
-        self.tree.write(fileout, encoding="utf-8", xml_declaration=True)
+        et.indent(self._root, space="\t")
+        self._tree.write(fileout, encoding="utf-8", xml_declaration=True)
         return True
 
     def _clear_changes(self):
@@ -65,17 +148,55 @@ class XmlUtils:
         self._change_index.clear()
 
     def create_patch(self, fileout: str, relative_path: str):
+        """Write the changes as a .py patch, or a declarative one if `fileout` ends with XML_PATCH_SUFFIX."""
         if not self._changes:
             return 2
         rel_path = relative_path.replace("\\", "/")
+        if fileout.endswith(XML_PATCH_SUFFIX):
+            content = self._json_patch(rel_path)
+        else:
+            content = self._python_patch(rel_path)
+
+        if not Utils.should_write(content, fileout):
+            self._clear_changes()
+            return 3
+
+        with open(fileout, "wb") as f:
+            f.write(content.encode("utf-8"))
+        self._clear_changes()
+        return 1
+
+    def _python_patch(self, rel_path: str) -> str:
         change_blocks = [
             f'def patch(game_files):\n\txml = game_files.xml("{rel_path}")\n'
         ]
 
-        for change in self._changes:
+        # targets are looked up in one walk of the tree, again only for
+        # paths into elements appended before them
+        batches = XmlUtils._find_batches(
+            (
+                change["xpath"],
+                [ele.tag for ele in change.get("element", ())],
+                change.get("diff", ()),
+            )
+            for change in self._changes
+        )
+        starts = {batch.start: batch for batch in batches}
+
+        for n, change in enumerate(self._changes):
+            batch = starts.get(n)
+            xpaths = batch and dict.fromkeys(
+                other["xpath"] for other in self._changes[batch] if other["xpath"]
+            )
+            if xpaths:
+                change_blocks.append("\n\ttargets" if n else "\ttargets")
+                change_blocks.append(" = xml.find_many([\n")
+                change_blocks.extend(f"\t\t{quoteattr(xpath)},\n" for xpath in xpaths)
+                change_blocks.append("\t])\n")
+
             xpath = change["xpath"]
             if xpath:
-                target = f"\n\ttarget = xml.root.find({quoteattr(xpath)})\n"
+                target = f"\n\ttarget = targets[{quoteattr(xpath)}]\n"
             else:
                 target = "\n\ttarget = xml.root\n"
             change_blocks.append(target)
@@ -103,18 +224,246 @@ class XmlUtils:
                 ]
                 change_blocks.extend(attr_map)
 
-        content = "".join(change_blocks)
+        return "".join(change_blocks)
 
-        if not Utils.should_write(content, fileout):
-            self._clear_changes()
-            return 3
+    def _json_patch(self, rel_path: str) -> str:
+        changes = []
+        for change in self._changes:
+            if change["type"] == "new":
+                xml_str = "".join(
+                    et.tostring(ele, encoding="unicode", with_tail=False)
+                    for ele in change["element"]
+                )
+                changes.append({"path": change["xpath"], "op": "append", "xml": xml_str})
+            elif change["type"] == "update":
+                changes.append({"path": change["xpath"], "op": "set", "attrib": change["diff"]})
+        return json.dumps({"file": rel_path, "changes": changes}, ensure_ascii=False, indent="\t") + "\n"
 
-        with open(fileout, "wb") as f:
-            f.write(content.encode("utf-8"))
-        self._clear_changes()
-        return 1
+    def apply_patch(self, changes: list[dict]):
+        """
+        Apply the "changes" of an XML_PATCH_SUFFIX file in order: each has a
+        find "path" ("" for the root) and an "op", "append" with "xml"
+        elements or "set" with "attrib". All "xml" is parsed at once and
+        targets are looked up in one walk, again only for paths that may
+        lead into elements appended, or attributes set, by earlier changes.
+        Nothing is applied if a target is missing: changes already made are
+        undone before raising.
+        """
+        for change in changes:
+            if change["op"] not in ("append", "set"):
+                raise ValueError(f"Unknown patch op: {change['op']}")
+
+        xml_strs = [change["xml"] for change in changes if change["op"] == "append"]
+        # one <f> per change, in the same order
+        fragments = iter(
+            et.fromstring(
+                "<patch>" + "".join(f"<f>{xml_str}</f>" for xml_str in xml_strs) + "</patch>",
+                parser=parser,
+            )
+            if xml_strs
+            else ()
+        )
+        elements = [
+            list(next(fragments)) if change["op"] == "append" else []
+            for change in changes
+        ]
+        batches = XmlUtils._find_batches(
+            (change["path"], [ele.tag for ele in eles], change.get("attrib", ()))
+            for change, eles in zip(changes, elements)
+        )
+
+        # (target, appended elements, {attribute: old value or None})
+        undo: list[tuple[Element, list[Element], dict]] = []
+        try:
+            for batch in batches:
+                # not self.root: the edits are known, no need to hash the tree
+                targets = self._find_many(
+                    self._root, (change["path"] for change in changes[batch])
+                )
+                missing = [path for path, target in targets.items() if target is None]
+                if missing:
+                    raise ValueError(
+                        f"Patch targets not found in {self.file_path}: {missing}"
+                    )
+
+                for change, eles in zip(changes[batch], elements[batch]):
+                    target = targets[change["path"]]
+                    assert target is not None
+                    if eles:
+                        target.extend(eles)
+                        undo.append((target, eles, {}))
+                    old = {}
+                    for k, v in change.get("attrib", {}).items():
+                        if target.get(k) != v:
+                            old[k] = target.get(k)
+                            target.set(k, v)
+                    if old:
+                        undo.append((target, [], old))
+                if undo:
+                    self._children_indexes.clear()
+        except BaseException:
+            for target, eles, old in reversed(undo):
+                for ele in eles:
+                    target.remove(ele)
+                for k, v in old.items():
+                    if v is None:
+                        del target.attrib[k]
+                    else:
+                        target.set(k, v)
+            raise
+
+        if undo:
+            self._modified = True
+
+    @staticmethod
+    def _find_batches(edits: Iterable[tuple]) -> List[slice]:
+        """
+        Split (path, appended tags, set attribute names) edits into runs
+        whose targets can be looked up together before the run. A path
+        that may pass through an element appended since the last lookup,
+        or test an attribute set since then, starts a new run: root.find
+        right before the edit could give another element.
+        """
+        batches = []
+        start = 0
+        appended: set[tuple] = set()  # (depth, tag) of appended elements
+        set_names: set[str] = set()
+        unknown = False  # an appended path _compile_path can't read
+        n = -1
+        for n, (path, tags, names) in enumerate(edits):
+            steps = XmlUtils._compile_path(path)
+            if steps is None:
+                stale = bool(appended or set_names or unknown)
+            else:
+                stale = unknown or any(
+                    (depth, tag) in appended
+                    or any(name in set_names for name, _ in conditions)
+                    for depth, (tag, conditions) in enumerate(steps)
+                )
+            if stale:
+                batches.append(slice(start, n))
+                start = n
+                appended.clear()
+                set_names.clear()
+                unknown = False
+
+            if tags:
+                if steps is None:
+                    unknown = True
+                else:
+                    appended.update((len(steps), tag) for tag in tags)
+            set_names.update(names)
+
+        if n >= start:
+            batches.append(slice(start, n + 1))
+        return batches
+
+    @staticmethod
+    @lru_cache(maxsize=4096)
+    def _compile_path(path: str) -> Optional[tuple]:
+        """
+        Steps of a `find` path as ((tag, ((name, value), ...)), ...), or None
+        for paths beyond what _build_xpath makes.
+        """
+        steps = []
+        pos = 0
+        while pos < len(path):
+            match = _PATH_STEP.match(path, pos)
+            if match is None:
+                return None
+            tag, predicates = match.group(1, 2)
+            conditions = tuple(
+                (m.group(1), m.group(2) if m.group(2) is not None else m.group(3))
+                for m in _PATH_PREDICATE.finditer(predicates)
+            )
+            pos = match.end()
+            if tag == ".":
+                # the element itself, as in find(".") or "./class"
+                if conditions:
+                    return None
+                continue
+            steps.append((tag, conditions))
+        return tuple(steps)
+
+    def find_cached(self, path: str) -> Optional[Element]:
+        """Same as xml.root.find(path), with `path` parsed once per process."""
+        return self.find_many([path])[path]
+
+    def find_many(self, paths: Iterable[str]) -> dict[str, Optional[Element]]:
+        """
+        Resolve many `find` paths at once, {path: element or None}, same as
+        calling xml.root.find(path) for each before editing the tree. Shared
+        parts of the paths are walked once, and each parent's children once.
+        A path leading into elements appended after the call may find another
+        element than root.find would then, look it up again after appending.
+        """
+        return self._find_many(self.root, paths)
+
+    @staticmethod
+    def _find_many(root: Element, paths: Iterable[str]) -> dict[str, Optional[Element]]:
+        found: dict[str, Optional[Element]] = {}
+        # trie node: [paths ending here, {step: node}]
+        trie: list = [[], {}]
+
+        for path in paths:
+            steps = XmlUtils._compile_path(path)
+            if steps is None:
+                found[path] = root.find(path)
+                continue
+            node = trie
+            for step in steps:
+                node = node[1].setdefault(step, [[], {}])
+            node[0].append(path)
+
+        # each node is reached with all its matches in document order, find
+        # gives the first match of the whole path, not of the first step
+        stack = [([root], trie)]
+        while stack:
+            candidates, (ending, next_steps) = stack.pop()
+            for path in ending:
+                found[path] = candidates[0]
+            if not next_steps:
+                continue
+
+            # tag -> condition names -> condition values -> step
+            by_tag: dict[str, dict[tuple, dict[tuple, tuple]]] = {}
+            for step in next_steps:
+                tag, conditions = step
+                names = tuple(name for name, _ in conditions)
+                values = tuple(value for _, value in conditions)
+                by_tag.setdefault(tag, {}).setdefault(names, {})[values] = step
+
+            matches: dict[tuple, list[Element]] = {}
+            for ele in candidates:
+                for child in ele:
+                    groups = by_tag.get(child.tag)
+                    if groups is None:
+                        continue
+                    for names, steps in groups.items():
+                        step = steps.get(tuple(child.get(name) for name in names))
+                        if step is not None:
+                            matches.setdefault(step, []).append(child)
+
+            for step, node in next_steps.items():
+                children = matches.get(step)
+                if children:
+                    stack.append((children, node))
+                else:
+                    for path in XmlUtils._paths_below(node):
+                        found[path] = None
+
+        return found
 
-    def _get_element_identifier(self, element: Element, ext: str):
+    @staticmethod
+    def _paths_below(node: list):
+        stack = [node]
+        while stack:
+            ending, next_steps = stack.pop()
+            yield from ending
+            stack.extend(next_steps.values())
+
+    @staticmethod
+    def _get_element_identifier(element: Element, ext: str):
         """
         Generates a unique identifier for an element.
         Return (tag, name, value); otherwise, (tag, None, None).
@@ -141,6 +490,18 @@ class XmlUtils:
         n, v = next(iter(element.attrib.items()), (None, None))
         return (element.tag, n, v)
 
+    @staticmethod
+    def _is_ignored(element: Element, ext: str) -> bool:
+        # ignore Condition tags + Action tags without ActionKey
+        return ext == ".stage" and (
+            element.tag == "Condition" or (element.tag == "Action" and not element.attrib.get("ActionKey"))
+        )
+
+    @staticmethod
+    def _is_not_unique(ele_id: tuple, ext: str) -> bool:
+        name = ele_id[1][0] if isinstance(ele_id[1], tuple) else ele_id[1]
+        return not name or (name[0].isupper() if ext != ".stage" else False)
+
     def _build_xpath(self, path: List[Tuple]):
         segments = []
 
@@ -165,10 +526,23 @@ class XmlUtils:
         return "/".join(segments)  # no "/" + because it point at root
         # "/" + for search from root, "//" + for search from everywhere
 
+    def _children_index(self, parent: Element, ext: str) -> dict[tuple, Element]:
+        index = self._children_indexes.get(parent)
+        if index is None:
+            index = {
+                self._get_element_identifier(child, ext): child
+                for child in parent
+                if not isinstance(child, Comment)
+            }
+            self._children_indexes[parent] = index
+        return index
+
     def _handle_new_element(self, parent: Element, ele: Element, xpath: str):
+        """Return True if `ele` was appended to `parent`."""
         if self.is_create_patch is None:
             parent.append(ele)
-            return
+            self._modified = True
+            return True
 
         key = (xpath, "new")
 
@@ -184,14 +558,17 @@ class XmlUtils:
             }
             self._changes.append(change)
             self._change_index[key] = change
+        return False
 
     def _handle_updated_attributes(self, target: Element, source: Element, xpath: str):
+        diff = {k: v for k, v in source.attrib.items() if target.attrib.get(k) != v}
+
         if self.is_create_patch is None:
-            target.attrib.update(source.attrib)
+            if diff:
+                target.attrib.update(diff)
+                self._modified = True
             return
 
-        diff = {k: v for k, v in source.attrib.items() if target.attrib.get(k) != v}
-
         if diff:
             self._changes.append(
                 {
@@ -208,33 +585,24 @@ class XmlUtils:
         while stack:
             tgt_ele, src_ele, path = stack.pop()
 
-            tgt_children_index = {
-                self._get_element_identifier(child, ext): child
-                for child in tgt_ele
-                if not isinstance(child, Comment)
-            }
+            tgt_children_index = self._children_index(tgt_ele, ext)
+            appended = []
 
             for src_child in src_ele:
-                if isinstance(src_child, Comment):
-                    continue
-                if ext == ".stage" and (src_child.tag == "Condition" or (src_child.tag == "Action" and not src_child.attrib.get("ActionKey"))):
-                    # ignore Condition tags + Action tags without ActionKey
+                if isinstance(src_child, Comment) or self._is_ignored(src_child, ext):
                     continue
 
                 ele_id = self._get_element_identifier(src_child, ext)
-                if isinstance(ele_id[1], tuple):
-                    name, value = ele_id[1][0], ele_id[1][1]
-                else:
-                    name, value = ele_id[1], ele_id[2]
                 tgt_child = tgt_children_index.get(ele_id)
 
-                not_unique = not name or (name[0].isupper() if ext != ".stage" else False)
+                not_unique = self._is_not_unique(ele_id, ext)
 
                 if tgt_child is None:
                     if not_unique:
                         continue
 
-                    self._handle_new_element(tgt_ele, src_child, self._build_xpath(path))
+                    if self._handle_new_element(tgt_ele, src_child, self._build_xpath(path)):
+                        appended.append((ele_id, src_child))
                     continue
 
                 current_path = path + [ele_id]
@@ -247,12 +615,20 @@ class XmlUtils:
 
                 self._handle_updated_attributes(tgt_child, src_child, self._build_xpath(current_path))
 
+            # index the new children only now: the rest of this mod's children
+            # are matched against the tree as it was, not against each other
+            tgt_children_index.update(appended)
+
     def merge_with(self, update_file: str, is_create_patch: Optional[bool]):
         update_tree = et.parse(update_file, parser=parser)
         update_root = update_tree.getroot()
+        # not self.root, it would drop the indexes
+        root = self._root
+        if root is None:
+            raise ValueError("XML root not initialized or empty")
 
-        if self.root.tag != update_root.tag:
-            raise ValueError(f"Root tags differ: {self.root.tag} vs {update_root.tag}")
+        if root.tag != update_root.tag:
+            raise ValueError(f"Root tags differ: {root.tag} vs {update_root.tag}")
 
         # if update_root.attrib:
         #     if self.root.attrib != update_root.attrib:
@@ -261,7 +637,190 @@ class XmlUtils:
 
         self.is_create_patch = is_create_patch
         self._clear_changes()
-        self._merge_elements(self.root, update_root, os.path.splitext(update_file)[1])
+        ext = os.path.splitext(update_file)[1]
+        if ext != self._index_ext:
+            self._children_indexes.clear()
+            self._index_ext = ext
+        self._merge_elements(root, update_root, ext)
+
+    @staticmethod
+    def merge_stream(base_file: str, update_file: str, fileout: str) -> bool:
+        """
+        Merge like merge_with, but stream the base document through iterparse
+        and write the result as it goes, so only the mod and the open path of
+        the base are in memory. Falls back to the tree merge for the few
+        documents it can't reproduce exactly.
+        Return True if `fileout` was written.
+        """
+        update_root = et.parse(update_file, parser=parser).getroot()
+        ext = os.path.splitext(update_file)[1]
+        tmp_file = f"{fileout}.tmp"
+
+        try:
+            with open(tmp_file, "wb") as f:
+                f.write(XML_DECLARATION)
+                changed = XmlUtils._write_merged(base_file, update_root, ext, f)
+        except _StreamConflict as e:
+            os.remove(tmp_file)
+            logging.debug(f"{base_file}: {e}, merging in memory")
+            xml = XmlUtils(base_file)
+            xml.merge_with(update_file, None)
+            return xml.writeto(fileout)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+
+        if not changed:
+            os.remove(tmp_file)
+            return False
+        os.replace(tmp_file, fileout)
+        return True
+
+    @staticmethod
+    def _write_merged(base_file: str, update_root: Element, ext: str, f) -> bool:
+        # Whitespace follows et.indent(space="\t"): text and tails that are only
+        # whitespace become indentation. A tail is only known once the next
+        # sibling starts, so each child is finished by the next one.
+        # Subtrees without mod children are kept until their end and written
+        # whole, unless they grow past STREAM_BUFFER_ELEMENTS.
+        changed = False
+        stack: list[_StreamFrame] = []
+        buffered: Optional[Element] = None
+        buffered_count = 0
+
+        # opened here so a _StreamConflict doesn't leave it to the GC
+        with open(base_file, "rb") as source, et.xmlfile(f, encoding="utf-8") as xf:
+            for event, elem in et.iterparse(
+                source,
+                events=("start", "end", "pi"),
+                collect_ids=False,
+                remove_comments=True,
+            ):
+                if event == "pi":
+                    raise _StreamConflict("processing instruction")
+
+                if event == "start":
+                    if buffered is not None:
+                        buffered_count += 1
+                        if buffered_count <= STREAM_BUFFER_ELEMENTS:
+                            continue
+                        XmlUtils._unbuffer(xf, stack, buffered, elem, ext)
+                        buffered, buffered_count = elem, 0
+                        continue
+
+                    if not stack:
+                        if elem.tag != update_root.tag:
+                            raise ValueError(f"Root tags differ: {elem.tag} vs {update_root.tag}")
+                        if elem.nsmap or elem.getroottree().docinfo.doctype:
+                            raise _StreamConflict("namespaces or doctype")
+                        stack.append(_StreamFrame(elem, 0, update_root, ext))
+                        continue
+
+                    parent = stack[-1]
+                    XmlUtils._next_child(xf, parent)
+                    mod = None
+                    if parent.mod_index is not None:
+                        ele_id = XmlUtils._get_element_identifier(elem, ext)
+                        candidates = parent.mod_index.get(ele_id)
+                        if candidates:
+                            # the tree merge matches the last of equal children
+                            if len(candidates) > 1 or ele_id in parent.matched:
+                                raise _StreamConflict(f"duplicate {ele_id}")
+                            parent.matched.add(ele_id)
+                            mod = candidates[0]
+                            if not XmlUtils._is_not_unique(ele_id, ext):
+                                diff = {k: v for k, v in mod.attrib.items() if elem.attrib.get(k) != v}
+                                if diff:
+                                    elem.attrib.update(diff)
+                                    changed = True
+                    if mod is None or not len(mod):
+                        buffered, buffered_count = elem, 0
+                        continue
+                    stack.append(_StreamFrame(elem, parent.depth + 1, mod, ext))
+                    continue
+
+                if buffered is not None:
+                    if elem is buffered:
+                        et.indent(elem, space="\t", level=stack[-1].depth + 1)
+                        stack[-1].pending = (elem, False)
+                        buffered = None
+                    continue
+
+                frame = stack.pop()
+                for ele_id, mod_child in frame.mod_children:
+                    if ele_id in frame.matched or XmlUtils._is_not_unique(ele_id, ext):
+                        continue
+                    XmlUtils._next_child(xf, frame)
+                    et.indent(mod_child, space="\t", level=frame.depth + 1)
+                    frame.pending = (mod_child, False)
+                    changed = True
+
+                if frame.opened is None:
+                    # no children, written whole once its tail is known
+                    if stack:
+                        stack[-1].pending = (elem, False)
+                    else:
+                        xf.write(elem)
+                    continue
+
+                XmlUtils._finish_pending(xf, frame, "\n" + "\t" * frame.depth)
+                frame.opened.__exit__(None, None, None)
+                elem.clear(keep_tail=True)
+                if stack:
+                    stack[-1].pending = (elem, True)
+
+        return changed
+
+    @staticmethod
+    def _unbuffer(xf, stack: list[_StreamFrame], buffered: Element, elem: Element, ext: str):
+        # stream the open path from `buffered` down to `elem`, whose earlier
+        # siblings at each level are complete and written whole
+        path = []
+        for ancestor in elem.iterancestors():
+            path.append(ancestor)
+            if ancestor is buffered:
+                break
+        path.reverse()
+        path.append(elem)
+
+        for ele, next_ele in zip(path, path[1:]):
+            frame = _StreamFrame(ele, stack[-1].depth + 1, None, ext)
+            stack.append(frame)
+            for child in list(ele):
+                XmlUtils._next_child(xf, frame)
+                if child is next_ele:
+                    break
+                et.indent(child, space="\t", level=frame.depth + 1)
+                frame.pending = (child, False)
+
+    @staticmethod
+    def _next_child(xf, frame: _StreamFrame):
+        # make room for a child: open the start tag or finish the previous one
+        indent = "\n" + "\t" * (frame.depth + 1)
+        if frame.opened is not None:
+            XmlUtils._finish_pending(xf, frame, indent)
+            return
+
+        elem = frame.elem
+        frame.opened = xf.element(elem.tag, dict(elem.attrib))
+        frame.opened.__enter__()
+        text = elem.text
+        xf.write(text if text and text.strip() else indent)
+
+    @staticmethod
+    def _finish_pending(xf, frame: _StreamFrame, indent: str):
+        if frame.pending is None:
+            return
+        child, started = frame.pending
+        frame.pending = None
+        tail = child.tail if child.tail and child.tail.strip() else indent
+        if started:
+            xf.write(tail)
+        else:
+            child.tail = tail
+            xf.write(child)
+        if child.getparent() is frame.elem:
+            frame.elem.remove(child)
 
     # def _add_comment_if_needed(
     #     self,
@@ -0,0 +1,49 @@
+import unittest
+
+from lxml import etree as et
+
+from lib.index_table import IndexTable
+
+# Package/index as the game ships it, plus the values extraction writes back
+INDEX = """<?xml version='1.0' encoding='utf-8'?>
+<index version="1">
+	<entry original="xml\\Mastery.xml" pack="xml.dat" method="encrypted_zip" virtual="3f2a" size="1024" csize="311"/>
+	<entry original="script/Ability.lua" pack="../Data/" method="raw" virtual="script/Ability.lua" size="77"/>
+	<entry size="5" csize="5" virtual="b 1" method="zip" pack="stage.dat" original="stage/a &amp; &lt;b&gt; &quot;c&quot;.stage"/>
+	<entry original="text/tab&#9;new&#10;line.txt" pack="text.dat"/>
+	<entry/>
+</index>
+"""
+
+
+class IndexTableTest(unittest.TestCase):
+    @staticmethod
+    def _shape(root):
+        return root.tag, root.attrib.items(), [
+            (child.tag, child.attrib.items()) for child in root
+        ]
+
+    def test_round_trip(self):
+        table = IndexTable.from_xml(INDEX.encode("utf-8"))
+        self.assertEqual(len(table), 5)
+        saved = b"".join(table.iter_xml(chunk_entries=2))
+        self.assertEqual(
+            self._shape(et.fromstring(saved)),
+            self._shape(et.fromstring(INDEX.encode("utf-8"))),
+        )
+        self.assertEqual(IndexTable.from_xml(saved).to_xml(), saved)
+
+    def test_unsupported_shape_raises(self):
+        for xml in [
+            b"<index><entry/><file/></index>",
+            b"<index><entry><part/></entry></index>",
+            b"<index><entry>text</entry></index>",
+            b"<index>text<entry/></index>",
+            b"<index><entry/><?pi?></index>",
+        ]:
+            with self.subTest(xml=xml), self.assertRaises(ValueError):
+                IndexTable.from_xml(xml)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,194 @@
+import os
+import tempfile
+import unittest
+
+from lib.lua_cache import LuaDefinitionCache
+from lib.lua_utils import LuaUtils, templates
+from lib.utils import Utils
+
+# repeated lines around every change, so one line of context is never unique
+BASE = """function f()
+	local x = 1;
+	if a then
+		return;
+	end
+	local x = 1;
+	if a then
+		return;
+	end
+	local x = 1;
+	if a then
+		return;
+	end
+end
+"""
+
+MOD = """function f()
+	local x = 1;
+	if a then
+		return;
+	end
+	local x = 1;
+	if a then
+		print('second');
+		return;
+	end
+	local x = 2;
+	if a then
+		return;
+	end
+	modded();
+end
+"""
+
+
+# changes far enough apart for one replace_code call each
+MOD_APART = """function f()
+	local x = 1;
+	local y = 1;
+	if a then
+		return;
+	end
+	local x = 1;
+	if a then
+		return;
+	end
+	local x = 1;
+	if a then
+		return 3;
+	end
+end
+"""
+
+
+class GameFiles:
+    def __init__(self, script):
+        self._script = script
+
+    def script(self, _):
+        return self._script
+
+
+class EditCodeTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.base_file = self._write("base.lua", BASE)
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _write(self, name, code):
+        path = os.path.join(self.tmp.name, name)
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(code)
+        return path
+
+    def _patched(self, patch_code):
+        script = LuaUtils(self.base_file)
+        namespace = {}
+        exec(patch_code, namespace)
+        namespace["patch"](GameFiles(script))
+        return Utils.remove_blank_lines(script.base_map["function f"])
+
+    def _create_patch(self, mod_code):
+        script = LuaUtils(self.base_file)
+        script.merge_with(self._write("mod.lua", mod_code), True)
+        diffs = script._diffs["function f"]
+        patch_file = os.path.join(self.tmp.name, "patch.py")
+        self.assertEqual(script.create_patch(patch_file, "script/f.lua"), 1)
+        with open(patch_file, "r", encoding="utf-8") as f:
+            return f.read(), diffs
+
+    def test_patch_rebuilds_mod(self):
+        patch_code, diffs = self._create_patch(MOD)
+        self.assertGreater(len(diffs), 1)
+        self.assertIn("edit_code", patch_code)
+
+        expected = LuaUtils._extract_definitions(MOD)["function f"]
+        expected = Utils.remove_blank_lines(expected)
+        self.assertEqual(self._patched(patch_code), expected)
+
+    def test_same_as_sequential_replace_code(self):
+        patch_code, diffs = self._create_patch(MOD_APART)
+        self.assertGreater(len(diffs), 1)
+
+        # the patch create_patch wrote before edit_code, one call per hunk
+        sequential = "".join(
+            ['def patch(game_files):\n\tscript = game_files.script("f.lua")\n']
+            + [templates[d["type"]].format(name="function f", **d) for d in diffs]
+        )
+        expected = Utils.remove_blank_lines(
+            LuaUtils._extract_definitions(MOD_APART)["function f"]
+        )
+        self.assertEqual(self._patched(sequential), expected)
+        self.assertEqual(self._patched(patch_code), expected)
+
+    def test_line_picks_nearest_match(self):
+        script = LuaUtils(self.base_file)
+        script.edit_code(
+            "function f",
+            [
+                {
+                    "type": "replace",
+                    "old_code": "\t\treturn;",
+                    "new_code": "\t\treturn 2;",
+                    "count": 1,
+                    "line": 7,
+                },
+            ],
+        )
+        lines = script.base_map["function f"].splitlines()
+        self.assertEqual(lines[7], "\t\treturn 2;")
+        self.assertEqual(lines.count("\t\treturn;"), 2)
+
+    def test_overlapping_edits_raise(self):
+        script = LuaUtils(self.base_file)
+        with self.assertRaises(ValueError):
+            script.edit_code(
+                "function f",
+                [
+                    {"type": "replace", "old_code": "local x = 1;", "new_code": "a"},
+                    {"type": "delete", "old_code": "x = 1"},
+                ],
+            )
+        unedited = LuaUtils(self.base_file).base_map["function f"]
+        self.assertEqual(script.base_map["function f"], unedited)
+
+
+class DefinitionCacheTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.cache_dir = os.path.join(self.tmp.name, "lua")
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def test_hit_and_prune(self):
+        cache = LuaDefinitionCache(self.cache_dir)
+        parsed = LuaUtils._parse_file(self._write_base(), self.cache_dir)[1]
+        self.assertEqual(cache.load(BASE), parsed)
+
+        # an entry of an older version, and one of the flat layout before it
+        stale = [
+            os.path.join(self.cache_dir, "00ff00ff00ff00ff", "ab"),
+            os.path.join(self.cache_dir, "ab"),
+        ]
+        for path in stale:
+            os.makedirs(path)
+            with open(os.path.join(path, "ab.json"), "w", encoding="utf-8") as f:
+                f.write("{}")
+        LuaDefinitionCache.prune(self.cache_dir)
+        self.assertEqual(
+            os.listdir(self.cache_dir), [os.path.basename(cache.version_dir)]
+        )
+        self.assertEqual(cache.load(BASE), parsed)
+
+    def _write_base(self):
+        path = os.path.join(self.tmp.name, "base.lua")
+        with open(path, "w", encoding="utf-8", newline="") as f:
+            f.write(BASE)
+        return path
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,301 @@
+import json
+import os
+import random
+import tempfile
+import unittest
+from unittest import mock
+
+from lxml import etree as et
+
+from lib.xml_utils import XML_PATCH_SUFFIX, XmlUtils
+
+XML_BASE = """<?xml version='1.0' encoding='UTF-8'?>
+<Root>
+	<!-- skills -->
+	<idspace id="Mastery">
+		<class name="EvilRobber" Cost="3"/>
+		<class name="Assassin" Cost="2">
+			<Desc Text="a &amp; b"/>
+		</class>
+	</idspace>
+	<idspace id="Item">
+		<class name="Potion" Price="10">text</class>
+	</idspace>
+</Root>
+"""
+
+XML_MOD = """<Root>
+	<idspace id="Mastery">
+		<class name="EvilRobber" Cost="1"/>
+		<class name="Assassin" Cost="2">
+			<Desc Text="say &quot;hi&quot; &lt;é&gt;"/>
+			<Extra Value="1"/>
+		</class>
+		<class name="NewMastery" Cost="2"/>
+		<class name="OtherMastery" Cost='4"'/>
+	</idspace>
+	<idspace id="Shop">
+		<class name="Sword" Price="5"/>
+	</idspace>
+</Root>
+"""
+
+STAGE_BASE = """<?xml version='1.0' encoding='UTF-8'?>
+<Stage>
+	<Objects>
+		<Object Key="Gate" Hp="10"/>
+		<Object Key="Wall" Hp="5"/>
+	</Objects>
+	<Triggers>
+		<Trigger Name="Start">
+			<Condition Type="Turn"/>
+			<Action ActionKey="Spawn" Count="1"/>
+		</Trigger>
+	</Triggers>
+</Stage>
+"""
+
+STAGE_MOD = """<Stage>
+	<Objects>
+		<Object Key="Gate" Hp="20"/>
+		<Object Key="Tower" Hp="7"/>
+	</Objects>
+	<Triggers>
+		<Trigger Name="Start">
+			<Condition Type="Dead"/>
+			<Action ActionKey="Spawn" Count="3"/>
+			<Action ActionKey="Talk"/>
+		</Trigger>
+	</Triggers>
+</Stage>
+"""
+
+
+class GameFiles:
+    def __init__(self, xml):
+        self._xml = xml
+
+    def xml(self, _):
+        return self._xml
+
+
+class XmlTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
+
+    def _path(self, name):
+        return os.path.join(self.tmp.name, name)
+
+    def _write(self, name, content):
+        with open(self._path(name), "w", encoding="utf-8") as f:
+            f.write(content)
+        return self._path(name)
+
+    def _read(self, name):
+        with open(self._path(name), "rb") as f:
+            return f.read()
+
+    def _create_patch(self, base_file, mod_file, fileout):
+        xml = XmlUtils(base_file)
+        xml.merge_with(mod_file, True)
+        self.assertEqual(xml.create_patch(fileout, "stage/test.stage"), 1)
+        with open(fileout, "r", encoding="utf-8") as f:
+            return f.read()
+
+    def _run_python_patch(self, base_file, patch_code, fileout):
+        xml = XmlUtils(base_file)
+        namespace = {}
+        exec(patch_code, namespace)
+        namespace["patch"](GameFiles(xml))
+        xml.writeto(self._path(fileout))
+        return self._read(fileout)
+
+
+class FindManyTest(XmlTestCase):
+    def setUp(self):
+        super().setUp()
+        # the appended Item is the first "B/Item" once it is in the tree
+        self.base_file = self._write(
+            "base.stage", '<root><B Name="1"/><B><Item x="1"/></B></root>'
+        )
+        self.mod_file = self._write(
+            "mod.stage",
+            '<root><B><Item Key="2"/><Item><Action ActionKey="3"/></Item></B></root>',
+        )
+
+    def test_find_many_matches_find(self):
+        xml = XmlUtils(self.base_file)
+        paths = ["B", "B/Item", 'B[@Name="1"]', "B/Item/Action", "C", ".", "./B/Item"]
+        found = xml.find_many(paths)
+        self.assertEqual(found, {path: xml.root.find(path) for path in paths})
+
+    def test_patch_finds_appended_elements(self):
+        patch_code = self._create_patch(
+            self.base_file, self.mod_file, self._path("patch.py")
+        )
+        self.assertEqual(patch_code.count("find_many"), 2)
+
+        # each target looked up right before its change
+        sequential = patch_code.replace("targets[", "xml.root.find(").replace(
+            '"]\n', '")\n'
+        )
+        expected = self._run_python_patch(self.base_file, sequential, "sequential")
+        self.assertIn(b'<Item Key="2">\n\t\t\t<Action ActionKey="3"/>', expected)
+        self.assertEqual(
+            self._run_python_patch(self.base_file, patch_code, "patched"), expected
+        )
+
+        json_file = self._path("test.stage" + XML_PATCH_SUFFIX)
+        patch = json.loads(self._create_patch(self.base_file, self.mod_file, json_file))
+        xml = XmlUtils(self.base_file)
+        xml.apply_patch(patch["changes"])
+        xml.writeto(self._path("applied"))
+        self.assertEqual(self._read("applied"), expected)
+
+
+class MergeStreamTest(XmlTestCase):
+    def _tree_merge(self, base_file, mod_file, fileout):
+        xml = XmlUtils(base_file)
+        xml.merge_with(mod_file, None)
+        return xml.writeto(self._path(fileout))
+
+    def _assert_same_as_tree_merge(self, ext, base, mod, streamed=True):
+        base_file = self._write("base" + ext, base)
+        mod_file = self._write("mod" + ext, mod)
+        expected = self._tree_merge(base_file, mod_file, "tree")
+
+        if streamed:
+            # no fallback to the tree merge
+            with mock.patch.object(XmlUtils, "merge_with", side_effect=AssertionError):
+                written = XmlUtils.merge_stream(base_file, mod_file, self._path("stream"))
+        else:
+            written = XmlUtils.merge_stream(base_file, mod_file, self._path("stream"))
+        self.assertEqual(written, expected)
+        if expected:
+            self.assertEqual(self._read("stream"), self._read("tree"))
+        self.assertFalse(os.path.exists(self._path("stream.tmp")))
+
+    def test_xml(self):
+        self._assert_same_as_tree_merge(".xml", XML_BASE, XML_MOD)
+
+    def test_stage(self):
+        self._assert_same_as_tree_merge(".stage", STAGE_BASE, STAGE_MOD)
+
+    def test_unchanged(self):
+        self._assert_same_as_tree_merge(".xml", XML_BASE, XML_BASE)
+
+    def test_random_documents(self):
+        rnd = random.Random(0)
+        for _ in range(200):
+            ext = rnd.choice([".xml", ".stage"])
+            base = self._random_element(rnd, ext, 0)
+            mod = et.fromstring(et.tostring(base))
+            for ele in list(mod.iter())[1:]:
+                if rnd.random() < 0.2 and ele.getparent() is not None:
+                    ele.getparent().remove(ele)
+                elif rnd.random() < 0.3:
+                    ele.attrib.update(self._random_attrib(rnd, ext))
+            for _ in range(rnd.randrange(3)):
+                parent = rnd.choice(list(mod.iter()))
+                parent.append(self._random_element(rnd, ext, 3))
+
+            with self.subTest(base=et.tostring(base), mod=et.tostring(mod)):
+                self._assert_same_as_tree_merge(
+                    ext,
+                    et.tostring(base, encoding="unicode"),
+                    et.tostring(mod, encoding="unicode"),
+                    streamed=False,
+                )
+
+    @staticmethod
+    def _random_attrib(rnd, ext):
+        names = ["Key", "Name", "ActionKey", "Value"] if ext == ".stage" else ["id", "Cap", "v"]
+        return {name: rnd.choice("abc") for name in rnd.sample(names, rnd.randrange(3))}
+
+    def _random_element(self, rnd, ext, depth):
+        tag = rnd.choice(["Item", "Group", "Condition"]) if depth else "Root"
+        ele = et.Element(tag, self._random_attrib(rnd, ext) if depth else {})
+        if depth < 4:
+            for _ in range(rnd.randrange(4)):
+                ele.append(self._random_element(rnd, ext, depth + 1))
+        return ele
+
+
+class ApplyPatchTest(XmlTestCase):
+    def _assert_same_as_python_patch(self, ext, base, mod):
+        base_file = self._write("base" + ext, base)
+        mod_file = self._write("mod" + ext, mod)
+        patch_code = self._create_patch(base_file, mod_file, self._path("patch.py"))
+        expected = self._run_python_patch(base_file, patch_code, "python")
+
+        json_file = self._path("test" + ext + XML_PATCH_SUFFIX)
+        patch = json.loads(self._create_patch(base_file, mod_file, json_file))
+        self.assertEqual(patch["file"], "stage/test.stage")
+        xml = XmlUtils(base_file)
+        xml.apply_patch(patch["changes"])
+        self.assertTrue(xml.writeto(self._path("json")))
+        self.assertEqual(self._read("json"), expected)
+
+    def test_xml(self):
+        self._assert_same_as_python_patch(".xml", XML_BASE, XML_MOD)
+
+    def test_stage(self):
+        self._assert_same_as_python_patch(".stage", STAGE_BASE, STAGE_MOD)
+
+    def test_missing_target_applies_nothing(self):
+        xml = XmlUtils(self._write("base.xml", XML_BASE))
+        changes = [
+            {"path": "idspace[@id='Item']", "op": "set", "attrib": {"v": "1"}},
+            {"path": "idspace[@id='None']", "op": "append", "xml": "<class/>"},
+        ]
+        with self.assertRaises(ValueError):
+            xml.apply_patch(changes)
+        self.assertFalse(xml.is_modified)
+
+    def test_missing_target_in_later_lookup_applies_nothing(self):
+        xml = XmlUtils(self._write("base.xml", "<root><a/></root>"))
+        changes = [
+            {"path": "", "op": "append", "xml": "<b/>"},
+            # looked up after the append, then "zz" is missing
+            {"path": "b", "op": "set", "attrib": {"k": "1"}},
+            {"path": "a", "op": "set", "attrib": {"k": "1"}},
+            {"path": "zz", "op": "set", "attrib": {"k": "1"}},
+        ]
+        edits = [("", ["b"], ()), ("b", [], ["k"]), ("a", [], ["k"]), ("zz", [], ["k"])]
+        self.assertEqual(len(XmlUtils._find_batches(edits)), 2)
+        with self.assertRaises(ValueError):
+            xml.apply_patch(changes)
+        self.assertFalse(xml.is_modified)
+        self.assertFalse(xml.writeto(self._path("out.xml")))
+        self.assertEqual(et.tostring(xml.root), b"<root><a/></root>")
+
+    def test_same_values_leave_file_unmodified(self):
+        xml = XmlUtils(self._write("base.xml", XML_BASE))
+        xml.apply_patch(
+            [
+                {
+                    "path": "idspace[@id='Item']/class",
+                    "op": "set",
+                    "attrib": {"Price": "10"},
+                },
+                {"path": ".", "op": "set", "attrib": {}},
+            ]
+        )
+        self.assertFalse(xml.is_modified)
+
+    def test_root_path(self):
+        xml = XmlUtils(self._write("base.xml", XML_BASE))
+        xml.apply_patch([{"path": ".", "op": "set", "attrib": {"v": "1"}}])
+        self.assertEqual(xml.root.get("v"), "1")
+
+    def test_unknown_op(self):
+        xml = XmlUtils(self._write("base.xml", XML_BASE))
+        with self.assertRaises(ValueError):
+            xml.apply_patch([{"path": "", "op": "remove"}])
+
+
+if __name__ == "__main__":
+    unittest.main()